@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+#
+# async_command
+#
+# AsyncSerialCommand
+#
+# asyncio version of SerialCommand, for use from event loop
+# based run control.  Requires python 3.5 or later, and
+# pyserial-asyncio to open a real port.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import asyncio
+import time
+import laserball_exception
+import laserball_logger
+import serial_command
+from serial_command import command_pulse_height, command_pulse_width, \
+    command_pulse_number, command_pulse_delay, expected_echo, \
+    compile_command, compiled_command, CompiledCommand, EchoParser, PendingEchoes
+
+
+def _encode(command):
+    """Wire bytes for a command string or list"""
+    if isinstance(command, str):
+        command = [command]
+    return "".join(command).encode("latin-1")
+
+
+class SimulatedStreams(object):
+    """asyncio stream reader/writer pair around a pyserial-like device,
+    e.g. a serial_simulator.SimulatedSerial.  The device is polled
+    every poll seconds for incoming data.
+    """
+
+    def __init__(self, device, poll=0.001):
+        self.serial = device
+        self._poll = poll
+        self._closed = False
+
+    # reader
+    async def read(self, n=-1):
+        while not self._closed:
+            waiting = self.serial.inWaiting()
+            if waiting:
+                if n > 0:
+                    waiting = min(waiting, n)
+                return self.serial.read(waiting)
+            await asyncio.sleep(self._poll)
+        return b""
+
+    # writer
+    @property
+    def transport(self):
+        return self
+
+    def write(self, data):
+        self.serial.write(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self._closed = True
+        self.serial.close()
+
+
+class AsyncSerialCommand(serial_command.SettingsCache):
+    """Serial command object for asyncio.
+
+    Uses the command encoders and setting cache of SerialCommand, but
+    all waiting is done by awaiting the stream so the event loop is
+    never blocked.  A background task reads the port and completes the
+    current sequence when the end of sequence is seen.
+    """
+
+    def __init__(self, reader, writer, port_name=None, baud_rate=2400, port_timeout=1.0):
+        super(AsyncSerialCommand, self).__init__()
+        self._reader = reader
+        self._writer = writer
+        self._port_name = port_name
+        self._baud_rate = baud_rate
+        self._port_timeout = port_timeout
+        self._sleep = 0.005
+        self.logger = laserball_logger.LaserballLogger.get_instance()
+        self._buffer = ""
+        #end of sequence characters in echoes are not ends
+        self._echoes = PendingEchoes()
+        self._data = asyncio.Event()
+        self._sequence = None
+        self._lock = asyncio.Lock()
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def open(cls, port_name, baud_rate=2400, port_timeout=1.0):
+        """Open a real port, needs pyserial-asyncio"""
+        import serial_asyncio
+        try:
+            reader, writer = await serial_asyncio.open_serial_connection(url=port_name, baudrate=baud_rate)
+        except Exception as e:
+            raise laserball_exception.LaserballSerialException(e)
+        return cls(reader, writer, port_name, baud_rate, port_timeout)
+
+    @classmethod
+    def simulated(cls, device=None, **kwargs):
+        """Connect to a simulated chip (a new SimulatedSerial with
+        kwargs unless device is given)"""
+        if device is None:
+            import serial_simulator
+            device = serial_simulator.SimulatedSerial(**kwargs)
+        streams = SimulatedStreams(device)
+        return cls(streams, streams, device.port, device.baudrate or 2400)
+
+    async def close(self):
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+        self._writer.close()
+
+    async def _read_loop(self):
+        while True:
+            data = await self._reader.read(100)
+            if not data:
+                return
+            data = data.decode("latin-1")
+            if self._echoes.ends(data):
+                self._firing = False
+                self._firing_continuous = False
+                if self._sequence is not None and not self._sequence.done():
+                    self._sequence.set_result(time.time())
+            self._buffer += data
+            self._data.set()
+
+    def _take_buffer(self):
+        buffer_read = self._buffer
+        self._buffer = ""
+        self._data.clear()
+        return buffer_read
+
+    def _char_time(self):
+        return float(serial_command._bits_per_char) / self._baud_rate
+
+    async def _write(self, data):
+        """Write bytes, registering their echo first"""
+        self._echoes.expect(data.decode("latin-1"), 3 * len(data) * self._char_time() +
+                            len(data) * self._sleep + self._port_timeout)
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _read_quiet(self, timeout):
+        """Read until the line has been quiet for a few character times,
+        for up to timeout"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        quiet = 2 * self._char_time() + self._sleep
+        buffer_read = self._take_buffer()
+        while True:
+            remaining = min(quiet, deadline - loop.time())
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._data.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+            buffer_read += self._take_buffer()
+        return buffer_read
+
+    async def _wait_ready(self, timeout):
+        """Send stops until one is echoed, for up to timeout.  The echoes
+        still due for the stops that went unanswered are forgotten once
+        one is echoed."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        expected = expected_echo([serial_command._cmd_stop])
+        wait = 2 * len(expected) * self._char_time() + 2 * self._sleep
+        while True:
+            self._take_buffer()
+            await self._write(_encode(serial_command._cmd_stop))
+            parser = EchoParser(expected, strict=False)
+            await self._read_echo(parser, min(wait, deadline - loop.time()))
+            if parser.success():
+                self._echoes.forget()
+                return
+            if loop.time() >= deadline:
+                raise laserball_exception.LaserballException("No response from %s after reset" % self._port_name)
+
+    async def _read_echo(self, parser, timeout):
+        """Feed the parser until it is complete or timeout passes"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not parser.complete():
+            if not self._buffer:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._data.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            parser.feed(self._take_buffer())
+        return parser
+
+    async def _send_command(self, command, readout=True, strict=True):
+        """Send a command and check its echo.  If not strict, command
+        characters other than the echo are skipped."""
+        if type(command) is not CompiledCommand:
+            command = compile_command(command)
+        self.logger.debug("_send_command:%s", command.command)
+        data = command.data.encode("latin-1")
+        buffer_check = command.buffer_check
+        command = command.command
+        try:
+            await self._write(data)
+        except Exception:
+            raise laserball_exception.LaserballException("Lost connection with Laserball control!")
+        if not readout:
+            return
+        timeout = (len(data) + len(buffer_check)) * self._char_time() + len(command) * self._sleep + self._port_timeout
+        parser = await self._read_echo(EchoParser(buffer_check, strict=strict), timeout)
+        if not parser.success():
+            self.logger.debug("problem reading buffer, send %s, read %s,", command, parser.raw)
+            remainder = await self._read_quiet(self._port_timeout)
+            self._echoes.forget()
+            if not (self._firing or self._firing_continuous):
+                # a stop would end the sequence
+                try:
+                    await self._wait_ready(self._port_timeout)
+                except laserball_exception.LaserballException:
+                    self.logger.warn("Could not resynchronise with %s", self._port_name)
+            message = "Unexpected buffer output:\nsaw: %s, remainder %s,\nexpected: %s" % (parser.echo, remainder, buffer_check)
+            self.logger.warn(message)
+            raise laserball_exception.LaserballException(message)
+        self.logger.debug("success reading buffer:%s", parser.echo)
+
+    async def wait_sequence(self, timeout=None):
+        """Wait for the current fire sequence to finish"""
+        if self._firing and self._sequence is not None:
+            await asyncio.wait_for(asyncio.shield(self._sequence), timeout)
+
+    async def _lock_idle(self, while_fire=False):
+        """Take the command lock once no sequence is running (or straight
+        away if while_fire).  The sequence is waited for without holding
+        the lock, so that stop() can still be run."""
+        while True:
+            if self._firing and not while_fire:
+                await self.wait_sequence()
+            await self._lock.acquire()
+            if not self._firing or while_fire:
+                return
+            # another fire got the lock first
+            self._lock.release()
+
+    async def _send_setting_command(self, command, while_fire=False):
+        """Send a setting under the command lock"""
+        await self._lock_idle(while_fire)
+        try:
+            if self._firing_continuous and not while_fire:
+                raise laserball_exception.LaserballException("Cannot fire, already in continuous firing mode")
+            if self._firing or self._firing_continuous:
+                #the buffer may hold PIN readout as well as the echo, so
+                #only the echoed command characters are checked
+                self._take_buffer()
+                await self._send_command(command, strict=False)
+            else:
+                self._take_buffer()
+                await self._send_command(command)
+        finally:
+            self._lock.release()
+
+    async def reset(self, hold=3.0, timeout=6.0):
+        """Send a reset using RTS, needs access to the underlying port.
+        RTS is held for hold seconds.  Once released, and anything the
+        box sends while booting has stopped, it is polled with stop
+        commands until it echoes one, for up to timeout seconds."""
+        self.logger.debug("Reset!")
+        port = getattr(self._writer.transport, "serial", None)
+        if port is None:
+            raise laserball_exception.LaserballException("Reset needs the serial port")
+        async with self._lock:
+            port.setRTS(True)
+            await asyncio.sleep(hold)
+            port.setRTS(False)
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + timeout
+            self._firing = False
+            self._firing_continuous = False
+            if self._sequence is not None and not self._sequence.done():
+                self._sequence.set_result(time.time())
+            #the box has lost its settings
+            self.clear_settings()
+            while await self._read_quiet(deadline - loop.time()):
+                if loop.time() >= deadline:
+                    break
+            await self._wait_ready(deadline - loop.time())
+            self._take_buffer()
+
+    async def fire(self, while_fire=False):
+        """Fire laserball.  Returns once the fire command has been
+        echoed, with a future that completes at the end of sequence."""
+        self.logger.debug("Fire!")
+        await self._lock_idle(while_fire)
+        try:
+            if self._firing_continuous and not while_fire:
+                raise laserball_exception.LaserballException("Cannot fire, already in continuous firing mode")
+            self.check_ready()
+            if self._sequence is not None and not self._sequence.done():
+                self._sequence.set_result(time.time())
+            self._sequence = asyncio.get_event_loop().create_future()
+            self._firing = True
+            self._take_buffer()
+            try:
+                await self._send_command(serial_command._cmd_fire_series)
+            except laserball_exception.LaserballException:
+                self._firing = False
+                self._sequence.cancel()
+                raise
+            self._force_setting = False
+            return self._sequence
+        finally:
+            self._lock.release()
+
+    async def fire_continuous(self):
+        """Fire laserball in continuous mode"""
+        await self._lock_idle()
+        try:
+            await self._send_command(serial_command._cmd_fire_continuous, readout=False)
+            self._firing_continuous = True
+            self._force_setting = False
+        finally:
+            self._lock.release()
+
+    async def stop(self):
+        """Stop firing laserball"""
+        self.logger.debug("Stop firing!")
+        async with self._lock:
+            firing = self._firing or self._firing_continuous
+            buffer_contents = self._take_buffer()
+            await self._send_command(serial_command._cmd_stop, readout=False)
+            #read the echo, and the end of sequence if still firing, so
+            #that a late end of sequence cannot complete the next fire.
+            #Echoes of commands sent while firing may still be arriving first.
+            parser = EchoParser(expected_echo([serial_command._cmd_stop]), wait_end=firing, strict=False)
+            timeout = 2 * len(parser.expected) * self._char_time() + self._sleep + self._port_timeout
+            buffer_contents += (await self._read_echo(parser, timeout)).raw
+            self._firing = False
+            self._firing_continuous = False
+            if self._sequence is not None and not self._sequence.done():
+                self._sequence.set_result(time.time())
+            return buffer_contents
+
+    async def clear_channel(self):
+        """Unselect the channel"""
+        self.logger.debug("Clear channel")
+        async with self._lock:
+            await self._send_command(serial_command._cmd_channel_clear)
+            self._force_setting = True
+            self.clear_settings()
+
+    async def set_pulse_height(self, par):
+        """Set the pulse height for the laserball"""
+        if self._cached("_current_ph", par):
+            return
+        self.logger.debug("Set pulse height %s %s", par, type(par))
+        command = compiled_command(command_pulse_height, par)
+        await self._send_setting_command(command)
+        self._current_ph = par
+
+    async def set_pulse_width(self, par, while_fire=False):
+        """Set the pulse width, can be done while firing"""
+        if self._cached("_current_pw", par):
+            return
+        self.logger.debug("Set pulse width %s %s", par, type(par))
+        command = compiled_command(command_pulse_width, par)
+        await self._send_setting_command(command, while_fire=while_fire)
+        self._current_pw = par
+
+    async def set_pulse_number(self, par):
+        """Set the number of pulses to fire"""
+        if self._cached("_current_pn", par):
+            return
+        self.logger.debug("Set pulse number %s %s", par, type(par))
+        command = compiled_command(command_pulse_number, par)
+        await self._send_setting_command(command)
+        self._current_pn = par
+
+    async def set_pulse_delay(self, par):
+        """Set the delay between pulses"""
+        if self._cached("_current_pd", par):
+            return
+        self.logger.debug("Set pulse delay %s %s", par, type(par))
+        command = compiled_command(command_pulse_delay, par)
+        await self._send_setting_command(command)
+        self._current_pd = par
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# benchmark.py
+#
+# Latency benchmarks for serial_command, run against
+# the simulated control chip in serial_simulator
+#
+# History:
+# 2026/10/16: First instance
+#
+###################################
+###################################
+import json
+import optparse
+import sys
+import time
+import serial_command
+import serial_simulator
+
+# Settings used by the workloads, as in example.py but with
+# sequences short enough to repeat many times
+height = 8000
+width = 0
+delay = 1
+number = 20
+
+
+class Recorder(object):
+    """Collect per-operation latency and bytes on the wire"""
+
+    def __init__(self, device):
+        self._device = device
+        self.samples = {}
+
+    def time(self, name, func, *args, **kwargs):
+        written = self._device.bytes_written
+        read = self._device.bytes_read
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        sample = (elapsed, self._device.bytes_written - written, self._device.bytes_read - read)
+        self.samples.setdefault(name, []).append(sample)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of values"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(round(pct / 100. * (len(values) - 1)))
+    return values[rank]
+
+
+def summarise(samples):
+    summary = {}
+    for name, ops in samples.items():
+        latency = [op[0] for op in ops]
+        summary[name] = {"count": len(ops),
+                         "mean": sum(latency) / len(latency),
+                         "p50": percentile(latency, 50),
+                         "p90": percentile(latency, 90),
+                         "p99": percentile(latency, 99),
+                         "max": max(latency),
+                         "total": sum(latency),
+                         "bytes_written": sum(op[1] for op in ops),
+                         "bytes_read": sum(op[2] for op in ops)}
+    return summary
+
+
+def new_command(options):
+    device = serial_simulator.SimulatedSerial(baudrate=options.baud, latency=options.latency,
+                                              processing_time=options.processing)
+    sc = serial_command.SerialCommand(device=device, pipelined=not options.legacy,
+                                      baud_rate=options.baud, adaptive=options.adaptive)
+    return sc, device
+
+
+def setup(sc):
+    """Set up the board as in example.py"""
+    sc.clear_channel()
+    sc.set_pulse_height(height)
+    sc.set_pulse_width(width)
+    sc.set_pulse_delay(delay)
+    sc.set_pulse_number(number)
+
+
+def setup_batched(sc):
+    """Set up the board with a single settings write"""
+    sc.clear_channel()
+    sc.apply_settings(height=height, width=width, number=number, delay=delay)
+
+
+def bench_cold_setup(options):
+    """Full setup from a freshly opened connection"""
+    samples = {}
+    for i in range(options.iterations):
+        for name, function in (("setup", setup), ("setup_batched", setup_batched)):
+            sc, device = new_command(options)
+            rec = Recorder(device)
+            rec.time(name, function, sc)
+            samples.setdefault(name, []).extend(rec.samples[name])
+    return samples
+
+
+def bench_repeat_fire(options):
+    """Repeated fire with unchanged settings"""
+    sc, device = new_command(options)
+    setup(sc)
+    rec = Recorder(device)
+    for i in range(options.iterations):
+        rec.time("fire", sc.fire)
+    return rec.samples
+
+
+def bench_height_sweep(options):
+    """Pulse height sweep, firing at each point"""
+    sc, device = new_command(options)
+    setup(sc)
+    rec = Recorder(device)
+    step = serial_command._max_pulse_height // max(options.iterations, 1)
+    for i in range(options.iterations):
+        rec.time("set_pulse_height", sc.set_pulse_height, i * step)
+        rec.time("fire", sc.fire)
+    return rec.samples
+
+
+def bench_width_while_fire(options):
+    """Pulse width updates during a long firing sequence"""
+    sc, device = new_command(options)
+    setup(sc)
+    rec = Recorder(device)
+    sc.fire_continuous()
+    for i in range(options.iterations):
+        rec.time("set_pulse_width", sc.set_pulse_width, (i + 1) * 100, while_fire=True)
+    rec.time("stop", sc.stop)
+    return rec.samples
+
+
+workloads = [("cold_setup", bench_cold_setup),
+             ("repeat_fire", bench_repeat_fire),
+             ("height_sweep", bench_height_sweep),
+             ("width_while_fire", bench_width_while_fire)]
+
+
+def print_summary(results, reference=None):
+    print("%-18s %-17s %6s %9s %9s %9s %9s %8s %8s" % ("workload", "operation", "count", "p50 ms",
+                                                      "p90 ms", "p99 ms", "max ms", "tx B/op", "rx B/op"))
+    for workload, summary in sorted(results["workloads"].items()):
+        for name, s in sorted(summary.items()):
+            line = "%-18s %-17s %6d %9.2f %9.2f %9.2f %9.2f %8.1f %8.1f" % \
+                (workload, name, s["count"], s["p50"] * 1e3, s["p90"] * 1e3, s["p99"] * 1e3,
+                 s["max"] * 1e3, float(s["bytes_written"]) / s["count"], float(s["bytes_read"]) / s["count"])
+            try:
+                ref = reference["workloads"][workload][name]
+                line += "  p50 x%.2f" % (s["p50"] / ref["p50"])
+            except (KeyError, TypeError, ZeroDivisionError):
+                pass
+            print(line)
+
+
+if __name__=="__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", dest="iterations", type="int", default=20, help="Operations per workload")
+    parser.add_option("-w", dest="workloads", default=None,
+                      help="Comma separated workloads (%s)" % ",".join(w[0] for w in workloads))
+    parser.add_option("-o", dest="output", default=None, help="Save results as JSON")
+    parser.add_option("-c", dest="compare", default=None, help="JSON results to compare against")
+    parser.add_option("--baud", dest="baud", type="int", default=2400)
+    parser.add_option("--latency", dest="latency", type="float", default=0.002, help="Chip response latency (s)")
+    parser.add_option("--processing", dest="processing", type="float", default=0.002,
+                      help="Chip processing time per command (s)")
+    parser.add_option("--legacy", dest="legacy", action="store_true", default=False,
+                      help="Use the unpipelined transport")
+    parser.add_option("--adaptive", dest="adaptive", action="store_true", default=False,
+                      help="Set deadlines from the observed echo latency")
+    (options, args) = parser.parse_args()
+
+    selected = workloads
+    if options.workloads:
+        names = options.workloads.split(",")
+        selected = [w for w in workloads if w[0] in names]
+        if len(selected) != len(names):
+            parser.error("Unknown workload in %s" % options.workloads)
+
+    results = {"time": time.strftime("%Y/%m/%d-%H:%M:%S"),
+               "options": vars(options),
+               "workloads": {}}
+    for name, func in selected:
+        sys.stderr.write("Running %s\n" % name)
+        results["workloads"][name] = summarise(func(options))
+
+    reference = None
+    if options.compare:
+        reference = json.load(open(options.compare))
+    print_summary(results, reference)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# continuous_session
+#
+# ContinuousSession
+#
+# Stream pulse width updates to the laserball while it
+# fires in continuous mode.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import threading
+import time
+import laserball_exception
+import serial_command
+
+
+class ContinuousSession(object):
+    """Continuous firing with pulse width updates sent from a
+    background thread as fast as the serial link allows.
+
+    Widths are given either with stream(), which only takes the next
+    value from the iterator once the link is free (backpressure), or
+    with update(), which never blocks: if a value is still waiting to
+    be sent it is replaced by the newer one (coalesced).  Each update
+    waits for its echo, so a width the box did not take raises in the
+    producer.  max_rate limits the number of updates sent per second.
+
+    with ContinuousSession(sc) as session:
+        session.stream(ramp)
+    """
+
+    def __init__(self, sc, max_rate=None):
+        self._sc = sc
+        self._min_interval = 0. if not max_rate else 1. / max_rate
+        self._cond = threading.Condition()
+        self._pending = None
+        self._sending = False
+        self._running = False
+        self._thread = None
+        self._error = None
+        self.sent = 0
+        self.coalesced = 0
+        self.start_time = None
+        self.end_time = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start continuous firing and the sending thread"""
+        self._sc.fire_continuous()
+        self._running = True
+        self._error = None
+        self.start_time = time.time()
+        self.end_time = None
+        self._thread = threading.Thread(target=self._run, name="ContinuousSession")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def update(self, width):
+        """Queue a pulse width without blocking, replacing any
+        width that has not yet been sent"""
+        self._put(width, block=False)
+
+    def stream(self, widths):
+        """Send each width from an iterator in turn, only taking the
+        next value once the previous one has been handed to the link.
+        Returns the number of values taken."""
+        n = 0
+        for width in widths:
+            self._put(width, block=True)
+            n += 1
+        self.flush()
+        return n
+
+    def flush(self):
+        """Wait until the last queued width has been sent"""
+        with self._cond:
+            while (self._pending is not None or self._sending) and self._running:
+                self._cond.wait(0.1)
+        self._check_error()
+
+    def stop(self):
+        """Send any queued width, stop the thread and stop firing.
+        Returns the buffer contents read by SerialCommand.stop()."""
+        with self._cond:
+            while (self._pending is not None or self._sending) and self._running:
+                self._cond.wait(0.1)
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.end_time is None:
+            self.end_time = time.time()
+        buffer_contents = self._sc.stop()
+        self._check_error()
+        return buffer_contents
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.
+        end = self.end_time
+        if end is None:
+            end = time.time()
+        return end - self.start_time
+
+    def rate(self):
+        """Achieved updates per second"""
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.
+        return self.sent / elapsed
+
+    def stats(self):
+        return {"sent": self.sent,
+                "coalesced": self.coalesced,
+                "elapsed": self.elapsed(),
+                "rate": self.rate()}
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _put(self, width, block):
+        # check the value here so that errors reach the producer
+        serial_command.compiled_command(serial_command.command_pulse_width, width)
+        with self._cond:
+            if not self._running:
+                self._check_error()
+                raise laserball_exception.LaserballException("Continuous session is not running")
+            if self._pending is not None:
+                if block:
+                    while self._pending is not None and self._running:
+                        self._cond.wait(0.1)
+                    if not self._running:
+                        self._check_error()
+                        raise laserball_exception.LaserballException("Continuous session is not running")
+                else:
+                    self.coalesced += 1
+            self._pending = width
+            self._cond.notify_all()
+
+    def _run(self):
+        sc = self._sc
+        next_slot = time.time()
+        while True:
+            with self._cond:
+                while self._pending is None and self._running:
+                    self._cond.wait(0.1)
+                if self._pending is None:
+                    return
+                width = self._pending
+                self._pending = None
+                self._sending = True
+                self._cond.notify_all()
+            delay = next_slot - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_slot = time.time() + self._min_interval
+            try:
+                if not sc.is_firing_continuous():
+                    raise laserball_exception.LaserballException("Continuous firing has stopped")
+                sc.set_pulse_width(width, while_fire=True)
+            except Exception as e:
+                sc.logger.warn("Continuous session failed: %s", e)
+                with self._cond:
+                    self._error = e
+                    self._running = False
+                    self._pending = None
+                    self._sending = False
+                    self.end_time = time.time()
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.sent += 1
+                self._sending = False
+                self._cond.notify_all()
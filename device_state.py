@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# device_state
+#
+# DeviceStateStore
+#
+# Keeps the last confirmed settings of each control box in a
+# file, so they survive reconnects and process restarts.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+settings = ["height", "width", "number", "delay"]
+
+# unchanged settings are saved again, to refresh their time, at most
+# this often (seconds)
+_refresh_interval = 60.
+
+
+class DeviceStateStore(object):
+    """JSON file of the settings held by each control box, keyed by
+    port name (or any other key, e.g. a device serial number).
+
+    The file is rewritten atomically (written to a temporary file in
+    the same directory then renamed over the old one) on every save,
+    so a crash never leaves a partial file behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                states = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(states, dict):
+            return {}
+        return states
+
+    def _write(self, states):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".device_state", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(states, f, sort_keys=True, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.rename(temp_path, self.path)
+            except OSError:
+                # rename cannot replace an existing file on windows
+                os.remove(self.path)
+                os.rename(temp_path, self.path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def load(self, key):
+        """Stored settings for key as a dict, or None"""
+        with self._lock:
+            state = self._read().get(key)
+        if not isinstance(state, dict):
+            return None
+        return state
+
+    def save(self, key, height, width, number, delay):
+        """Store the settings for key.  Unknown settings are None."""
+        state = {"height": height,
+                 "width": width,
+                 "number": number,
+                 "delay": delay,
+                 "time": time.time()}
+        with self._lock:
+            states = self._read()
+            if states.get(key) is not None and \
+                    all(states[key].get(s) == state[s] for s in settings) and \
+                    state["time"] - states[key].get("time", 0) < _refresh_interval:
+                return
+            states[key] = state
+            self._write(states)
+
+    def invalidate(self, key):
+        """Forget the settings for key"""
+        with self._lock:
+            states = self._read()
+            if key in states:
+                del states[key]
+                self._write(states)
+
+    def keys(self):
+        with self._lock:
+            return list(self._read().keys())
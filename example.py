@@ -33,8 +33,9 @@ if __name__=="__main__":
     sc.set_pulse_width(width)
     sc.set_pulse_delay(delay)
     sc.set_pulse_number(number)
-    #fire sequence
-    sc.fire()
+    #fire sequence, other work can be done until it has finished
+    handle = sc.fire()
+    handle.wait()
 
     #fire continuously
     #sc.fire_continuous()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+#
+# laserball_daemon
+#
+# LaserballDaemon, LaserballClient
+#
+# Long running process that owns the SerialCommand and serves
+# requests from any number of clients on a local Unix socket.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import json
+import optparse
+import os
+import signal
+import socket
+import threading
+import time
+import laserball_exception
+import laserball_logger
+import serial_command
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# Protocol: one JSON object per line each way.  A request is
+#   {"id": 1, "op": "set", "height": 8000, "width": 0}
+# and is answered with
+#   {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false, "error": "..."}
+# Operations:
+#   get     cached settings and firing state, never touches the link
+#   set     any of height, width, number, delay
+#   fire    start a sequence, with "wait": true to reply once it ends
+#   wait    wait for the current sequence to end ("timeout" optional)
+#   stop    stop firing, sent straight away rather than queued
+#   status  queue and traffic counters
+#   ping
+default_path = "/tmp/laserball.sock"
+
+settings = ["height", "width", "number", "delay"]
+
+
+def _text(data):
+    """Buffer contents as text that survives the JSON encoding"""
+    if isinstance(data, bytes):
+        return data.decode("latin-1")
+    return data
+
+
+class _Job(object):
+    """Request waiting for the worker thread"""
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+        self.result = None
+        self.error = None
+        self._event = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._event.set()
+
+    def wait(self):
+        # wait in steps, a timed wait can be interrupted (python 2)
+        while not self._event.wait(1.0):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class LaserballDaemon(object):
+    """Serves a SerialCommand on a Unix socket.
+
+    Requests that need the link are queued and run one at a time by a
+    worker thread.  Settings requests waiting next to each other in the
+    queue are merged into a single apply_settings (later values win), and
+    apply_settings skips any value the box already holds, so clients
+    asking for the same settings add no serial traffic.  get is answered
+    from the cached settings without queueing.
+    """
+
+    def __init__(self, sc, path=default_path):
+        self._sc = sc
+        self.path = path
+        self.logger = laserball_logger.LaserballLogger.get_instance()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._worker = None
+        self._server = None
+        self.requests = collections.Counter()
+        self.coalesced = 0
+        self.start_time = None
+
+    def start(self):
+        """Bind the socket and start the worker, without serving"""
+        if os.path.exists(self.path):
+            # only replace a socket nobody is listening on
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise laserball_exception.LaserballException("Daemon already running on %s" % self.path)
+            finally:
+                probe.close()
+        self._server = _Server(self.path, _Handler)
+        self._server.laserball_daemon = self
+        self._running = True
+        self.start_time = time.time()
+        self._worker = threading.Thread(target=self._run, name="LaserballDaemon")
+        self._worker.daemon = True
+        self._worker.start()
+        self.logger.log("Laserball daemon listening on %s" % self.path)
+        return self
+
+    def serve_forever(self):
+        if self._server is None:
+            self.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """Stop serve_forever, from another thread"""
+        if self._server is not None:
+            self._server.shutdown()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        # anything still queued is not going to run
+        while self._queue:
+            self._queue.popleft().finish(error=laserball_exception.LaserballException("Daemon stopped"))
+
+    def handle(self, request):
+        """Run a request (a dict), returns the result"""
+        op = request.get("op")
+        with self._cond:
+            self.requests[str(op)] += 1
+        if op == "get":
+            return self.get()
+        if op == "ping":
+            return "pong"
+        if op == "status":
+            return self.status()
+        if op == "stop":
+            return _text(self._sc.stop())
+        if op == "wait":
+            return self._sc.wait_sequence(request.get("timeout"))
+        if op == "set":
+            values = dict((name, request[name]) for name in settings if request.get(name) is not None)
+            if not values:
+                return []
+            # check the values here, so a bad request cannot fail the
+            # requests it is merged with
+            for name, attribute, encoder in serial_command._settings:
+                if name in values:
+                    serial_command.compiled_command(encoder, values[name])
+            return self._submit("set", values)
+        if op == "fire":
+            handle = self._submit("fire", {})
+            if not request.get("wait"):
+                return {"expected_time": handle.expected_time}
+            return {"expected_time": handle.expected_time,
+                    "duration": handle.result(request.get("timeout"))}
+        raise laserball_exception.LaserballException("Unknown request: %r" % op)
+
+    def get(self):
+        """Cached settings and firing state"""
+        sc = self._sc
+        result = sc.settings()
+        result.update(firing=sc.is_firing(),
+                      firing_continuous=sc.is_firing_continuous(),
+                      connected=sc.is_connected())
+        return result
+
+    def status(self):
+        with self._cond:
+            queued = len(self._queue)
+        return {"queued": queued,
+                "coalesced": self.coalesced,
+                "requests": dict(self.requests),
+                "uptime": time.time() - self.start_time}
+
+    def _submit(self, op, args):
+        job = _Job(op, args)
+        with self._cond:
+            if not self._running:
+                raise laserball_exception.LaserballException("Daemon stopped")
+            self._queue.append(job)
+            self._cond.notify_all()
+        return job.wait()
+
+    def _next(self):
+        """Take the next job, and any settings jobs queued right behind
+        it if it is one"""
+        with self._cond:
+            while not self._queue and self._running:
+                self._cond.wait(0.1)
+            if not self._queue:
+                return None
+            jobs = [self._queue.popleft()]
+            if jobs[0].op == "set":
+                while self._queue and self._queue[0].op == "set":
+                    jobs.append(self._queue.popleft())
+            return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._next()
+            if jobs is None:
+                return
+            try:
+                if jobs[0].op == "set":
+                    values = {}
+                    for job in jobs:
+                        values.update(job.args)
+                    self.coalesced += len(jobs) - 1
+                    result = self._sc.apply_settings(**values)
+                else:
+                    result = self._sc.fire()
+            except Exception as e:
+                self.logger.warn("Daemon %s failed: %s", jobs[0].op, e)
+                for job in jobs:
+                    job.finish(error=e)
+            else:
+                for job in jobs:
+                    job.finish(result)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One client connection, any number of requests"""
+
+    def handle(self):
+        daemon = self.server.laserball_daemon
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            request_id = None
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be an object")
+                request_id = request.get("id")
+                reply = {"id": request_id, "ok": True, "result": daemon.handle(request)}
+            except Exception as e:
+                reply = {"id": request_id, "ok": False, "error": str(e)}
+            try:
+                self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except socket.error:
+                return
+
+
+class LaserballClient(object):
+    """Connection to a LaserballDaemon.  Methods raise
+    LaserballException if the daemon reports an error.
+    One request at a time per client (thread safe)."""
+
+    def __init__(self, path=default_path, timeout=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rb")
+        self._lock = threading.Lock()
+        self._id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+
+    def request(self, op, **args):
+        with self._lock:
+            self._id += 1
+            args["op"] = op
+            args["id"] = self._id
+            self._socket.sendall((json.dumps(args) + "\n").encode("utf-8"))
+            line = self._file.readline()
+        if not line:
+            raise laserball_exception.LaserballException("Daemon closed the connection")
+        reply = json.loads(line.decode("utf-8"))
+        if not reply.get("ok"):
+            raise laserball_exception.LaserballException(reply.get("error"))
+        return reply.get("result")
+
+    def get(self):
+        return self.request("get")
+
+    def get_pulse_delay(self):
+        return self.get()["delay"]
+
+    def get_pulse_number(self):
+        return self.get()["number"]
+
+    def set(self, height=None, width=None, number=None, delay=None):
+        """Returns the names of the settings that had to be sent"""
+        return self.request("set", height=height, width=width, number=number, delay=delay)
+
+    def fire(self, wait=False, timeout=None):
+        return self.request("fire", wait=wait, timeout=timeout)
+
+    def wait(self, timeout=None):
+        return self.request("wait", timeout=timeout)
+
+    def stop(self):
+        return self.request("stop")
+
+    def status(self):
+        return self.request("status")
+
+
+if __name__=="__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-p", dest="port", default=None, help="Serial port")
+    parser.add_option("-s", dest="socket", default=default_path, help="Socket path [%default]")
+    parser.add_option("--state", dest="state", default=None, help="Device state file")
+    parser.add_option("--status", dest="status", default=None, help="Status block file for monitors")
+    parser.add_option("--simulate", dest="simulate", action="store_true", default=False,
+                      help="Use a simulated control box")
+    (options, args) = parser.parse_args()
+    device = None
+    if options.simulate:
+        import serial_simulator
+        device = serial_simulator.SimulatedSerial()
+    sc = serial_command.SerialCommand(options.port, device=device, state_store=options.state,
+                                      status=options.status)
+    sc.connect()
+    daemon = LaserballDaemon(sc, options.socket).start()
+
+    def terminate(signum, frame):
+        # shutdown waits for serve_forever, so cannot be called from its thread
+        threading.Thread(target=daemon.shutdown).start()
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        sc.close()
@@ -13,26 +13,129 @@
 #                     <jw419@sussex.ac.uk>
 #
 # History: 2014/05/23 Adapted for DEAP
+#          2026/10/16 Messages written from a background thread
 #
 ###########################################
 
+import atexit
 import os
+import sys
+import threading
 import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class LogWriter(object):
+    """Writes log records from a background thread.
+
+    Records are batched, printed and appended to a day file that is
+    kept open until the day changes.
+    """
+
+    _max_batch = 256
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_name = None
+        self._curtime = (None, None)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="LogWriter")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def put(self, message, log_file=None, colour=None):
+        if self._thread is None:
+            self.start()
+        self._queue.put((time.time(), message, log_file, colour))
+
+    def flush(self):
+        """Block until all queued records have been written"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_name = None
+
+    def _format_time(self, timestamp):
+        # many records share the same second, only format once
+        second = int(timestamp)
+        if self._curtime[0] != second:
+            self._curtime = (second, time.strftime("%Y/%m/%d-%H:%M:%S", time.localtime(second)))
+        return self._curtime[1]
+
+    def _get_file(self, log_file, timestamp):
+        curday = time.strftime("_%Y_%m_%d", time.localtime(timestamp))
+        file_name = log_file + curday + '.log'
+        if file_name != self._file_name:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(file_name, 'a')
+            self._file_name = file_name
+        return self._file
+
+    def _write(self, records):
+        console = []
+        used = []
+        for timestamp, message, log_file, colour in records:
+            output = self._format_time(timestamp) + ": " + message
+            if log_file is not None:
+                f = self._get_file(log_file, timestamp)
+                f.write(output + '\n')
+                if f not in used:
+                    used.append(f)
+            if colour is not None:
+                output = colour + output + '\033[0m'
+            console.append(output + '\n')
+        for f in used:
+            if not f.closed:
+                f.flush()
+        sys.stdout.write("".join(console))
+        sys.stdout.flush()
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < self._max_batch:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(records)
+            except Exception as e:
+                sys.stderr.write("LogWriter failed: %s\n" % e)
+            for record in records:
+                self._queue.task_done()
+
+
+_writer = LogWriter()
+atexit.register(_writer.close)
 
 
 def log_message(message, log_file=None, colour=None):
     '''Print a message, log to file as well if possible.
+    The message is written by a background thread.
     '''
-    curtime = time.strftime("%Y/%m/%d-%H:%M:%S")
-    output = curtime + ": " + message
-    if log_file is not None:
-        curday = time.strftime("_%Y_%m_%d")
-        log_file = log_file + curday + '.log'
-        f = open(log_file, 'a')
-        f.write(output + '\n')
-    if colour is not None:
-        output = colour + output + '\033[0m'
-    print output
+    _writer.put(message, log_file, colour)
+
+
+def flush():
+    '''Wait for all logged messages to be written.
+    '''
+    _writer.flush()
 
 
 class LaserballLogger:
@@ -72,12 +175,53 @@ class LaserballLogger:
     def set_log_file(self, log_file):
         self._log_file = log_file
 
-    def log(self, message):
+    def is_debug(self):
+        return self._debug_mode
+
+    def log(self, message, *args):
+        if args:
+            message = message % args
         log_message(message, self._log_file)
 
-    def debug(self, message):
+    def debug(self, message, *args):
+        """Arguments are only formatted into the message in debug mode"""
         if self._debug_mode:
+            if args:
+                message = message % args
             log_message("DEBUG: " + message, self._log_file, self._coldbg)
 
-    def warn(self, message):
+    def warn(self, message, *args):
+        if args:
+            message = message % args
         log_message("WARN: " + message, self._log_file, self._colwarn)
+
+    def flush(self):
+        flush()
+
+
+class TaggedLogger(object):
+    """Logger that prefixes each message with a tag (e.g. a port name),
+    for use when several control boxes log to the same place.
+    """
+
+    def __init__(self, tag, logger=None):
+        if logger is None:
+            logger = LaserballLogger.get_instance()
+        self._logger = logger
+        self._prefix = "[%s] " % tag
+
+    def is_debug(self):
+        return self._logger.is_debug()
+
+    def log(self, message, *args):
+        self._logger.log(self._prefix + message, *args)
+
+    def debug(self, message, *args):
+        if self._logger.is_debug():
+            self._logger.debug(self._prefix + message, *args)
+
+    def warn(self, message, *args):
+        self._logger.warn(self._prefix + message, *args)
+
+    def flush(self):
+        self._logger.flush()
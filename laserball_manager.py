@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# laserball_manager
+#
+# LaserballManager
+#
+# Drive several laserball control boxes at once
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import device_state
+import laserball_exception
+import laserball_logger
+import serial_command
+
+PortResult = collections.namedtuple("PortResult", ["value", "error"])
+
+
+class LaserballManager(object):
+    """Owns a SerialCommand for each port and runs commands on all
+    of them in parallel, one thread per box.  Calls return an ordered
+    dict of port: PortResult, with the error set (and value None) for
+    any box that failed.
+    """
+
+    def __init__(self, ports=(), pipelined=True, state_store=None):
+        """state_store is a device_state.DeviceStateStore (or file
+        name) shared by all the boxes"""
+        self._pipelined = pipelined
+        if isinstance(state_store, str):
+            state_store = device_state.DeviceStateStore(state_store)
+        self._state_store = state_store
+        self._commands = collections.OrderedDict()
+        self._pool = None
+        self._pool_size = 0
+        self.logger = laserball_logger.LaserballLogger.get_instance()
+        ports = list(ports)
+        results = self._run(self._open, ports)
+        for port in ports:
+            if results[port].error is None:
+                self._commands[port] = results[port].value
+        for port in ports:
+            if results[port].error is not None:
+                self.close()
+                raise results[port].error
+
+    def _open(self, port, device=None):
+        sc = serial_command.SerialCommand(port, pipelined=self._pipelined, device=device,
+                                          state_store=self._state_store)
+        sc.logger = laserball_logger.TaggedLogger(port, self.logger)
+        sc.connect()
+        return sc
+
+    def add(self, port, device=None):
+        """Add a control box, device as in SerialCommand"""
+        if port in self._commands:
+            raise laserball_exception.LaserballException("Port already managed: %s" % port)
+        self._commands[port] = self._open(port, device)
+        return self._commands[port]
+
+    def __getitem__(self, port):
+        return self._commands[port]
+
+    def __len__(self):
+        return len(self._commands)
+
+    def ports(self):
+        return list(self._commands.keys())
+
+    def _call(self, func, port):
+        try:
+            return PortResult(func(port), None)
+        except Exception as e:
+            laserball_logger.TaggedLogger(port, self.logger).warn("%s failed: %s",
+                                                                  getattr(func, "__name__", "call"), e)
+            return PortResult(None, e)
+
+    def _run_async(self, func, ports):
+        if self._pool is None or self._pool_size < len(ports):
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = ThreadPool(processes=len(ports))
+            self._pool_size = len(ports)
+        return self._pool.map_async(lambda port: self._call(func, port), ports)
+
+    def _run_now(self, func, ports):
+        """Call func(port) for every port in a thread of its own, so it
+        runs even while the pool is busy (e.g. waiting for sequences)"""
+        results = [None] * len(ports)
+
+        def call(i, port):
+            results[i] = self._call(func, port)
+        threads = [threading.Thread(target=call, args=(i, port)) for i, port in enumerate(ports)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return collections.OrderedDict(zip(ports, results))
+
+    def _run(self, func, ports):
+        if not ports:
+            return collections.OrderedDict()
+        results = self._run_async(func, ports).get()
+        return collections.OrderedDict(zip(ports, results))
+
+    def map(self, func, ports=None):
+        """Call func(port) for every port in parallel"""
+        if ports is None:
+            ports = self.ports()
+        return self._run(func, ports)
+
+    def apply(self, method, *args, **kwargs):
+        """Call a SerialCommand method on every box in parallel"""
+        def call(port):
+            return getattr(self._commands[port], method)(*args, **kwargs)
+        call.__name__ = method
+        return self.map(call)
+
+    def configure(self, height=None, width=None, number=None, delay=None, settings=None, clear=False):
+        """Set up all boxes in parallel.  Settings left as None are not
+        changed.  settings can be a dict of port: dict of setting overrides
+        for individual boxes.
+        """
+        defaults = {"height": height, "width": width, "number": number, "delay": delay}
+
+        def configure(port):
+            sc = self._commands[port]
+            values = dict(defaults)
+            if settings and port in settings:
+                values.update(settings[port])
+            if clear:
+                sc.clear_channel()
+            sc.apply_settings(**values)
+
+        return self.map(configure)
+
+    def fire(self, stagger=0.0, wait=True, timeout=None):
+        """Fire all boxes.  With stagger 0 the fire commands are released
+        together once every box is ready, otherwise the boxes are fired
+        stagger seconds apart in port order.  If wait is True waits for all
+        sequences to finish.  Values are the FireHandle for each box.
+        """
+        ports = self.ports()
+        if not ports:
+            return collections.OrderedDict()
+        ready = threading.Semaphore(0)
+        go = threading.Event()
+
+        def fire(port):
+            sc = self._commands[port]
+            try:
+                # finish any running sequence before lining up
+                sc.wait_sequence()
+            finally:
+                ready.release()
+            go.wait()
+            if stagger:
+                time.sleep(stagger * ports.index(port))
+            handle = sc.fire()
+            if wait and not handle.wait(timeout):
+                raise laserball_exception.LaserballException("Sequence not finished after %s s" % timeout)
+            return handle
+
+        pending = self._run_async(fire, ports)
+        for port in ports:
+            ready.acquire()
+        go.set()
+        return collections.OrderedDict(zip(ports, pending.get()))
+
+    def stop(self):
+        """Stop all boxes, straight away even if a fire is waiting for
+        its sequences to finish"""
+        def stop(port):
+            return self._commands[port].stop()
+        return self._run_now(stop, self.ports())
+
+    def close(self):
+        """Close all the ports"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+            self._pool_size = 0
+        for sc in self._commands.values():
+            sc.close()
+        self._commands.clear()
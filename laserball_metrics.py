@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# laserball_metrics
+#
+# Metrics, NullMetrics
+#
+# Counters and timers for the serial command hot paths
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import functools
+import threading
+import time
+import laserball_logger
+
+
+class Metrics(object):
+    """Thread safe counters and timers.
+
+    Counters are integers (e.g. bytes written, cache hits); timers keep
+    the number of calls, total and maximum time for each name.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+            self._timers = {}
+            self._start = time.time()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def get_count(self, name):
+        return self._counts.get(name, 0)
+
+    def snapshot(self):
+        """Current values as a dict of plain types"""
+        with self._lock:
+            timers = {}
+            for name, (calls, total, longest) in self._timers.items():
+                timers[name] = {"calls": calls,
+                                "total": total,
+                                "mean": total / calls,
+                                "max": longest}
+            return {"time": time.time(),
+                    "elapsed": time.time() - self._start,
+                    "counts": dict(self._counts),
+                    "timers": timers}
+
+
+class NullMetrics(Metrics):
+    """Metrics that record nothing, used when instrumentation is off"""
+
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def add_time(self, name, seconds):
+        pass
+
+    def get_count(self, name):
+        return 0
+
+    def snapshot(self):
+        return {"time": time.time(), "elapsed": 0., "counts": {}, "timers": {}}
+
+
+null_metrics = NullMetrics()
+
+
+def timed(name):
+    """Decorator timing a method under name with its object's metrics.
+    Only an attribute lookup is added when the metrics are disabled."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.add_time(name, time.time() - start)
+        return wrapper
+    return decorate
+
+
+class SnapshotDumper(object):
+    """Periodically write metric snapshots, as JSON lines appended to
+    path or through the logger if no path is given.
+    """
+
+    def __init__(self, metrics, interval=60., path=None, logger=None):
+        self._metrics = metrics
+        self._interval = interval
+        self._path = path
+        self._logger = logger
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="SnapshotDumper")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop dumping, after writing a final snapshot"""
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self):
+        import json
+        line = json.dumps(self._metrics.snapshot(), sort_keys=True)
+        if self._path is not None:
+            with open(self._path, "a") as f:
+                f.write(line + "\n")
+        else:
+            logger = self._logger
+            if logger is None:
+                logger = laserball_logger.LaserballLogger.get_instance()
+            logger.log("METRICS: %s", line)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.dump()
+        self.dump()
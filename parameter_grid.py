@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# parameter_grid
+#
+# encode_points, EncodedGrid
+#
+# Validate and encode many (height, width, number, delay)
+# points at once with numpy.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import laserball_exception
+import parameters
+import serial_command
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# error mask bits for each setting
+ERROR_HEIGHT = 1
+ERROR_WIDTH = 2
+ERROR_NUMBER = 4
+ERROR_DELAY = 8
+
+# bytes of each setting in an encoded row, in the same form as the
+# command encoders: L hi M lo P, Q hi R lo S, H hi G lo, u ms us
+row_size = 17
+columns = {"height": slice(0, 5),
+           "width": slice(5, 10),
+           "number": slice(10, 14),
+           "delay": slice(14, 17)}
+_fixed_bytes = {0: serial_command._cmd_ph_hi,
+                2: serial_command._cmd_ph_lo,
+                4: serial_command._cmd_ph_end,
+                5: serial_command._cmd_pw_hi,
+                7: serial_command._cmd_pw_lo,
+                9: serial_command._cmd_pw_end,
+                10: serial_command._cmd_pn_hi,
+                12: serial_command._cmd_pn_lo,
+                14: serial_command._cmd_pd}
+
+_tables = None
+
+
+class EncodedGrid(collections.namedtuple("EncodedGrid", ["data", "height", "width", "number", "delay", "errors"])):
+    """Result of encode_points.
+    data: uint8 array of shape (n, row_size), the command bytes for
+    each point (zero where the point is invalid).
+    height, width, number, delay: the values the box will apply.
+    errors: per point mask of ERROR_* bits, 0 if the point is valid.
+    """
+
+    __slots__ = ()
+
+    def valid(self):
+        """Boolean mask of the valid points"""
+        return self.errors == 0
+
+    def command(self, i, settings=("height", "width", "number", "delay")):
+        """Wire bytes to send the given settings of point i"""
+        if self.errors[i]:
+            raise laserball_exception.LaserballException("Invalid point %d: %s" % (i, describe_errors(self.errors[i])))
+        return b"".join(self.data[i, columns[setting]].tobytes() for setting in settings)
+
+
+def describe_errors(mask):
+    """Names of the settings flagged in an error mask"""
+    names = []
+    for bit, name in ((ERROR_HEIGHT, "height"), (ERROR_WIDTH, "width"),
+                      (ERROR_NUMBER, "number"), (ERROR_DELAY, "delay")):
+        if mask & bit:
+            names.append(name)
+    return ", ".join(names)
+
+
+def _check_numpy():
+    if numpy is None:
+        raise laserball_exception.LaserballException("parameter_grid needs numpy")
+
+
+def _pulse_number_tables():
+    global _tables
+    if _tables is None:
+        below, hi = parameters.pulse_number_tables()
+        _tables = (numpy.frombuffer(below, dtype=numpy.uint16).astype(numpy.int64),
+                   numpy.frombuffer(hi, dtype=numpy.uint8).astype(numpy.int64))
+    return _tables
+
+
+def _integers(values, maximum):
+    """Integer values and mask of those that are non-integral or out of
+    [0, maximum]"""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    bad = ~numpy.isfinite(values) | (values < 0) | (values > maximum) | (values != numpy.floor(values))
+    return numpy.where(bad, 0, values).astype(numpy.int64), bad
+
+
+def encode_points(heights, widths, numbers, delays):
+    """Validate and encode points given as arrays (or scalars, which
+    are broadcast), following the same rules as the command_pulse_*
+    encoders: heights and widths must be integers in range, pulse
+    numbers (truncated to integers) must be exactly achievable as
+    hi*lo, and delays are quantised to ms + us/250.
+    Returns an EncodedGrid.
+    """
+    _check_numpy()
+    heights, widths, numbers, delays = numpy.broadcast_arrays(
+        numpy.asarray(heights), numpy.asarray(widths),
+        numpy.asarray(numbers), numpy.asarray(delays))
+    heights = heights.ravel()
+    widths = widths.ravel()
+    numbers = numbers.ravel()
+    delays = delays.ravel()
+    n_points = heights.shape[0]
+    errors = numpy.zeros(n_points, dtype=numpy.uint8)
+
+    height, bad = _integers(heights, serial_command._max_pulse_height)
+    errors[bad] |= ERROR_HEIGHT
+    width, bad = _integers(widths, serial_command._max_pulse_width)
+    errors[bad] |= ERROR_WIDTH
+
+    numbers = numpy.asarray(numbers, dtype=numpy.float64)
+    bad = ~numpy.isfinite(numbers) | (numbers < 0) | (numbers > serial_command._max_pulse_number)
+    number = numpy.where(bad, 0, numbers).astype(numpy.int64)
+    below, hi_table = _pulse_number_tables()
+    bad |= below[number] != number
+    number[bad] = 0
+    errors[bad] |= ERROR_NUMBER
+    pn_hi = hi_table[number]
+    pn_lo = number // numpy.maximum(pn_hi, 1)
+
+    delays = numpy.asarray(delays, dtype=numpy.float64)
+    bad = ~numpy.isfinite(delays) | (delays < 0) | (delays > serial_command._max_pulse_delay)
+    delays = numpy.where(bad, 0., delays)
+    ms = delays.astype(numpy.int64)
+    us = ((delays - ms) * 250).astype(numpy.int64)
+    # the ms byte cannot hold more than 255
+    bad |= ms > 255
+    ms[bad] = 0
+    us[bad] = 0
+    errors[bad] |= ERROR_DELAY
+
+    data = numpy.zeros((n_points, row_size), dtype=numpy.uint8)
+    for column, char in _fixed_bytes.items():
+        data[:, column] = ord(char)
+    data[:, 1] = height >> 8
+    data[:, 3] = height & 255
+    data[:, 6] = width >> 8
+    data[:, 8] = width & 255
+    data[:, 11] = pn_hi
+    data[:, 13] = pn_lo
+    data[:, 15] = ms
+    data[:, 16] = us
+    data[errors != 0] = 0
+
+    valid = errors == 0
+    return EncodedGrid(data,
+                       numpy.where(valid, height, -1),
+                       numpy.where(valid, width, -1),
+                       numpy.where(valid, number, -1),
+                       numpy.where(valid, ms + us / 250., numpy.nan),
+                       errors)
+
+
+def encode_plan(plan):
+    """Encode the points of a run_plan.RunPlan"""
+    _check_numpy()
+    if not len(plan):
+        return encode_points([], [], [], [])
+    heights, widths, numbers, delays = zip(*plan.points)
+    return encode_points(heights, widths, numbers, delays)
@@ -7,34 +7,117 @@
 #
 #######################
 #######################
-import math
+import array
+import bisect
 
 max_pulse_number = 65025
+max_pulse_number_upper = 255
+max_pulse_number_lower = 255
 
-def pulse_number(number):
-    adjusted = False
+# Lookup tables over 0..max_pulse_number, built on first use:
+#  _pn_below[n]: largest achievable hi*lo <= n
+#  _pn_above[n]: smallest achievable hi*lo >= n
+#  _pn_hi[p]: smallest hi with hi*lo == p (0 if p not achievable)
+_pn_below = None
+_pn_above = None
+_pn_hi = None
+_pn_achievable = None
+
+
+def _build_tables():
+    """Build the pulse number lookup tables"""
+    global _pn_below, _pn_above, _pn_hi, _pn_achievable
+    size = max_pulse_number + 1
+    hi_table = array.array('B', [0]) * size
+    # loop hi upwards so that the smallest hi is kept for each product,
+    # as the original brute force search did
+    for hi in range(1, max_pulse_number_upper + 1):
+        for lo in range(0, max_pulse_number_lower + 1):
+            if not hi_table[hi * lo]:
+                hi_table[hi * lo] = hi
+    below = array.array('H', [0]) * size
+    above = array.array('H', [0]) * size
+    last = 0
+    for n in range(size):
+        if hi_table[n]:
+            last = n
+        below[n] = last
+    last = max_pulse_number
+    for n in range(size - 1, -1, -1):
+        if hi_table[n]:
+            last = n
+        above[n] = last
+    _pn_achievable = [n for n in range(size) if hi_table[n]]
+    _pn_hi = hi_table
+    _pn_below = below
+    _pn_above = above
+
+
+def _check_pulse_number(number):
     if type(number)!=int:
         raise Exception("PN must be an integer")
     if number > max_pulse_number:
         raise Exception("PN must be < %d.  You set %d" % (65025, number))
-        #number = max_pulse_number
-        #adjusted = True
-    hi = -1
-    lo = -1
-    diff = 100000 # bigger than max pn
-    for i in range(1, 256):
-        #assume hi is i
-        lo_check = number/i
-        if lo_check > 255:
-            lo_check = 255
-        check = i * lo_check
-        if math.fabs(check - number) < diff:
-            diff = math.fabs(check - number)
-            hi = i
-            lo = lo_check
-        if check == number:
-            break
-    actual_par = hi * lo
-    if actual_par != number:
-        adjusted = True
+    if number < 0:
+        raise Exception("PN must be >= 0.  You set %d" % number)
+    if _pn_hi is None:
+        _build_tables()
+
+
+def _factorise(actual_par):
+    """Get the hi, lo pair for an achievable pulse number"""
+    hi = _pn_hi[actual_par]
+    return hi, actual_par // hi
+
+
+def pulse_number(number):
+    """Get the closest pulse number not above number that can be
+    set as hi*lo.  Returns adjusted, actual_par, hi, lo.
+    """
+    _check_pulse_number(number)
+    actual_par = _pn_below[number]
+    hi, lo = _factorise(actual_par)
+    adjusted = actual_par != number
     return adjusted, actual_par, hi, lo
+
+
+def nearest_pulse_number(number):
+    """Get the achievable pulse number nearest to number (rounding
+    down on a tie).  Returns actual_par, hi, lo.
+    """
+    _check_pulse_number(number)
+    below = _pn_below[number]
+    above = _pn_above[number]
+    if above - number < number - below:
+        actual_par = above
+    else:
+        actual_par = below
+    hi, lo = _factorise(actual_par)
+    return actual_par, hi, lo
+
+
+def is_achievable(number):
+    """Check if a pulse number can be set exactly"""
+    _check_pulse_number(number)
+    return _pn_hi[number] != 0
+
+
+def pulse_number_tables():
+    """The lookup tables as (below, hi): below[n] is the largest
+    achievable pulse number <= n and hi[p] the hi byte for an
+    achievable p (0 if p cannot be set).
+    """
+    if _pn_hi is None:
+        _build_tables()
+    return _pn_below, _pn_hi
+
+
+def achievable_pulse_numbers(minimum=0, maximum=max_pulse_number):
+    """List every pulse number in [minimum, maximum] that can be
+    set exactly.
+    """
+    if _pn_achievable is None:
+        _build_tables()
+    start = bisect.bisect_left(_pn_achievable, minimum)
+    stop = bisect.bisect_right(_pn_achievable, maximum)
+    return _pn_achievable[start:stop]
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+# run_file
+#
+# RunFile
+#
+# Load, validate and run calibration runs described in a
+# text file rather than hand-written python.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import math
+import optparse
+import time
+import laserball_exception
+import run_plan
+import serial_command
+
+# A run file has one step per line, # starts a comment:
+#
+#   set height=8000 width=0 number=12000 delay=1
+#   fire                           fire a sequence and wait for it to end
+#   continuous 2.5 widths=0,10,20  fire continuously for 2.5 s, stepping
+#                                  the pulse width evenly (widths optional)
+#   wait 1.0                       pause
+#   repeat 3                       repeat the steps up to the matching end
+#     set width=100
+#     fire
+#   end
+#
+# The whole file is checked when it is loaded: every value against the
+# limits of the command encoders, and every fire for settings left unset.
+
+Step = collections.namedtuple("Step", ["op", "args", "line"])
+Repeat = collections.namedtuple("Repeat", ["count", "steps", "line"])
+# a repeat once compiled: the steps of its first pass, and of each later one
+CompiledRepeat = collections.namedtuple("CompiledRepeat", ["count", "first", "rest", "line"])
+
+_encoders = run_plan._encoders
+_types = {"height": int, "width": int, "number": int, "delay": float}
+
+# most errors to report from one file
+_max_errors = 20
+
+
+class _Errors(object):
+    """Errors found in a run file, reported together"""
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+
+    def add(self, line, message):
+        self.messages.append("%s:%d: %s" % (self.name, line, message))
+
+    def check(self):
+        if self.messages:
+            shown = self.messages[:_max_errors]
+            if len(self.messages) > _max_errors:
+                shown.append("... and %d more" % (len(self.messages) - _max_errors))
+            raise laserball_exception.LaserballException("Invalid run file:\n" + "\n".join(shown))
+
+
+def _setting(name, text):
+    """Parse and check a setting value, raises ValueError"""
+    if name not in _encoders:
+        raise ValueError("Unknown setting: %s" % name)
+    try:
+        value = _types[name](text)
+    except ValueError:
+        raise ValueError("Bad %s: %s" % (name, text))
+    try:
+        serial_command.compiled_command(_encoders[name], value)
+    except laserball_exception.LaserballException as e:
+        raise ValueError(str(e))
+    return value
+
+
+def _seconds(text):
+    seconds = float(text)
+    if math.isnan(seconds) or math.isinf(seconds) or seconds < 0:
+        raise ValueError("Bad time: %s" % text)
+    return seconds
+
+
+def _parse_step(words):
+    op = words[0]
+    if op == "set":
+        if len(words) < 2:
+            raise ValueError("set needs at least one setting")
+        values = {}
+        for word in words[1:]:
+            name, sep, text = word.partition("=")
+            if not sep:
+                raise ValueError("Expected setting=value: %s" % word)
+            values[name] = _setting(name, text)
+        return "settings", values
+    if op == "fire":
+        if len(words) != 1:
+            raise ValueError("fire takes no arguments")
+        return "fire", None
+    if op == "wait":
+        if len(words) != 2:
+            raise ValueError("wait needs a time")
+        return "wait", _seconds(words[1])
+    if op == "continuous":
+        if len(words) not in (2, 3):
+            raise ValueError("continuous needs a time and optionally widths=...")
+        widths = []
+        if len(words) == 3:
+            name, sep, text = words[2].partition("=")
+            if name != "widths" or not sep:
+                raise ValueError("Expected widths=...: %s" % words[2])
+            widths = [_setting("width", width) for width in text.split(",")]
+        return "continuous", (_seconds(words[1]), widths)
+    raise ValueError("Unknown step: %s" % op)
+
+
+def parse(text, name="<run>"):
+    """Parse the text of a run file, returns a RunFile.
+    Raises LaserballException listing every error found."""
+    errors = _Errors(name)
+    blocks = [[]] # steps of the file and of each open repeat
+    repeats = []
+    for number, line in enumerate(text.splitlines(), 1):
+        words = line.split("#", 1)[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == "repeat":
+                if len(words) != 2 or not words[1].isdigit():
+                    raise ValueError("repeat needs a count")
+                repeats.append((int(words[1]), number))
+                blocks.append([])
+            elif words[0] == "end":
+                if len(words) != 1 or not repeats:
+                    raise ValueError("end without repeat")
+                count, start = repeats.pop()
+                steps = blocks.pop()
+                blocks[-1].append(Repeat(count, steps, start))
+            else:
+                op, args = _parse_step(words)
+                blocks[-1].append(Step(op, args, number))
+        except ValueError as e:
+            errors.add(number, str(e))
+    for count, start in repeats:
+        errors.add(start, "repeat without end")
+    errors.check()
+    run = RunFile(blocks[0], name)
+    run.compile()
+    return run
+
+
+def load(path):
+    """Load and check a run file"""
+    with open(path) as f:
+        return parse(f.read(), path)
+
+
+class RunFile(object):
+    """Steps of a parsed run file.  compile() gives the steps to run,
+    with settings already in place left out; unroll() iterates over them."""
+
+    def __init__(self, steps, name="<run>"):
+        self.steps = steps
+        self.name = name
+        # compiled from nothing known, which parse checks
+        self._compiled = None
+
+    def compile(self, start=None):
+        """Compile the run into (settings, fire, continuous, wait) Steps
+        and CompiledRepeats.  Consecutive settings are sent together,
+        only those that change from start (a run_plan.Point, default
+        nothing known) or earlier steps are sent, and consecutive waits
+        are merged.  Settings left pending at the end of a repeat are
+        sent there.  Raises LaserballException if a fire comes before
+        all the settings are known.
+
+        A repeat body is only compiled twice, whatever its count: the
+        first pass starts from the settings before the repeat, and every
+        later pass from those at the end of the first, so gives the same
+        steps (and any errors are found by the first)."""
+        if start is None and self._compiled is not None:
+            return self._compiled
+        errors = _Errors(self.name)
+        state = dict((name, None if start is None else getattr(start, name)) for name in run_plan.settings)
+        pending = {}
+        pending_line = [None]
+
+        def walk(steps):
+            compiled = []
+
+            def flush():
+                changed = dict((name, value) for name, value in pending.items() if state[name] != value)
+                if changed:
+                    compiled.append(Step("settings", changed, pending_line[0]))
+                    state.update(changed)
+                pending.clear()
+
+            for step in steps:
+                if isinstance(step, Repeat):
+                    if step.count == 0:
+                        continue
+                    first = walk(step.steps)
+                    if errors.messages:
+                        return compiled
+                    rest = walk(step.steps) if step.count > 1 else []
+                    if first or rest:
+                        compiled.append(CompiledRepeat(step.count, first, rest, step.line))
+                elif step.op == "settings":
+                    if not pending:
+                        pending_line[0] = step.line
+                    pending.update(step.args)
+                elif step.op == "wait":
+                    if compiled and isinstance(compiled[-1], Step) and compiled[-1].op == "wait":
+                        compiled[-1] = Step("wait", compiled[-1].args + step.args, compiled[-1].line)
+                    else:
+                        compiled.append(step)
+                else:
+                    flush()
+                    missing = [name for name in run_plan.settings if state[name] is None]
+                    if missing:
+                        errors.add(step.line, "%s before %s set" % (step.op, ", ".join(missing)))
+                    compiled.append(step)
+                    if step.op == "continuous" and step.args[1]:
+                        state["width"] = step.args[1][-1]
+            flush()
+            return compiled
+
+        compiled = walk(self.steps)
+        errors.check()
+        if start is None:
+            self._compiled = compiled
+        return compiled
+
+    def estimate(self, model=None, start=None):
+        """Predicted run time in seconds, with a timing_model.TimingModel"""
+        import timing_model
+        if model is None:
+            model = timing_model.TimingModel()
+        state = dict((name, None if start is None else getattr(start, name)) for name in run_plan.settings)
+
+        def total(steps):
+            seconds = 0.
+            for step in steps:
+                if isinstance(step, CompiledRepeat):
+                    seconds += total(step.first)
+                    if step.count > 1:
+                        # every later pass starts from the same settings
+                        seconds += (step.count - 1) * total(step.rest)
+                elif step.op == "settings":
+                    state.update(step.args)
+                    seconds += model.command_time_for(list(step.args), run_plan.Point(**state))
+                elif step.op == "fire":
+                    seconds += model.fire_time(state["number"], state["delay"])
+                elif step.op == "wait":
+                    seconds += step.args
+                elif step.op == "continuous":
+                    seconds += step.args[0]
+                    if step.args[1]:
+                        state["width"] = step.args[1][-1]
+            return seconds
+
+        return total(self.compile(start))
+
+    def summary(self, start=None):
+        """Counts of the compiled steps and settings sent"""
+
+        def count(steps):
+            counts = collections.Counter()
+            for step in steps:
+                if isinstance(step, CompiledRepeat):
+                    counts.update(count(step.first))
+                    for op, n in count(step.rest).items():
+                        counts[op] += (step.count - 1) * n
+                else:
+                    counts[step.op] += 1
+                    if step.op == "settings":
+                        counts["settings_sent"] += len(step.args)
+            return counts
+
+        return dict(count(self.compile(start)))
+
+    @staticmethod
+    def unroll(steps):
+        """Iterate over compiled steps with the repeats unrolled"""
+        for step in steps:
+            if isinstance(step, CompiledRepeat):
+                for unrolled in RunFile.unroll(step.first):
+                    yield unrolled
+                for i in range(step.count - 1):
+                    for unrolled in RunFile.unroll(step.rest):
+                        yield unrolled
+            else:
+                yield step
+
+    def execute(self, sc, callback=None):
+        """Run with a SerialCommand.  Settings the box already holds are
+        not sent.  callback(step, result) is called after each step, the
+        result of a fire being its FireHandle.  Returns a list of the
+        (step, FireHandle) of each fire."""
+        # any stored settings are restored on connecting
+        sc.connect()
+        steps = self.compile(run_plan.current_point(sc))
+        fires = []
+        for step in self.unroll(steps):
+            result = None
+            if step.op == "settings":
+                result = sc.apply_settings(**step.args)
+            elif step.op == "fire":
+                result = sc.fire()
+                sc.wait_fire(result).result()
+                fires.append((step, result))
+            elif step.op == "wait":
+                time.sleep(step.args)
+            elif step.op == "continuous":
+                self._continuous(sc, *step.args)
+            if callback is not None:
+                callback(step, result)
+        return fires
+
+    def _continuous(self, sc, seconds, widths):
+        sc.fire_continuous()
+        try:
+            start = time.time()
+            for i, width in enumerate(widths):
+                delay = start + i * seconds / len(widths) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                sc.set_pulse_width(width, while_fire=True)
+            delay = start + seconds - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        finally:
+            sc.stop()
+
+
+if __name__=="__main__":
+    parser = optparse.OptionParser(usage="%prog [options] run_file")
+    parser.add_option("-p", dest="port", default=None, help="Serial port")
+    parser.add_option("-c", "--check", dest="check", action="store_true", default=False,
+                      help="Only check the file and print a summary")
+    parser.add_option("--state", dest="state", default=None, help="Device state file")
+    parser.add_option("--simulate", dest="simulate", action="store_true", default=False,
+                      help="Use a simulated control box")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give a run file")
+    start = time.time()
+    run = load(args[0])
+    summary = run.summary()
+    print("%s is valid (checked in %.1f ms): %d fires, %d settings sent, estimated %.1f s" %
+          (args[0], (time.time() - start) * 1000., summary.get("fire", 0),
+           summary.get("settings_sent", 0), run.estimate()))
+    if not options.check:
+        device = None
+        if options.simulate:
+            import serial_simulator
+            device = serial_simulator.SimulatedSerial()
+        sc = serial_command.SerialCommand(options.port, device=device, state_store=options.state)
+        try:
+            start = time.time()
+            fires = run.execute(sc)
+            print("Finished %d fires in %.1f s" % (len(fires), time.time() - start))
+        finally:
+            sc.close()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# run_plan
+#
+# RunPlan
+#
+# Scans over laserball settings, ordered so that as few
+# settings as possible are resent between points.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import itertools
+import laserball_exception
+import serial_command
+
+Point = collections.namedtuple("Point", ["height", "width", "number", "delay"])
+
+settings = Point._fields
+
+_encoders = {"height": serial_command.command_pulse_height,
+             "width": serial_command.command_pulse_width,
+             "number": serial_command.command_pulse_number,
+             "delay": serial_command.command_pulse_delay}
+
+_setting_costs = {}
+
+# plans with at least this many points are validated with numpy
+_batch_validate = 1000
+
+
+def setting_cost(setting):
+    """Characters on the wire to resend a setting: the command, its
+    echo and the repeated command character for each element"""
+    if setting not in _setting_costs:
+        command, buffer_check = _encoders[setting](1)
+        data = "".join(command)
+        _setting_costs[setting] = 2 * len(data) + len(command)
+    return _setting_costs[setting]
+
+
+class RunPlan(object):
+    """A list of (height, width, number, delay) points to fire at.
+    """
+
+    def __init__(self, points):
+        self.points = [Point(*p) for p in points]
+
+    @classmethod
+    def grid(cls, heights, widths, numbers, delays, order="nested"):
+        """Plan every combination of the given settings"""
+        points = itertools.product(heights, widths, numbers, delays)
+        plan = cls(points)
+        if order is not None:
+            plan.order(order)
+        return plan
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def validate(self):
+        """Check every point can be sent, raises LaserballException if not.
+        Large plans are checked with parameter_grid when numpy is
+        available (it is only imported for them)."""
+        if len(self.points) >= _batch_validate:
+            import parameter_grid
+        if len(self.points) >= _batch_validate and parameter_grid.numpy is not None:
+            errors = parameter_grid.encode_plan(self).errors
+            if errors.any():
+                i = int(parameter_grid.numpy.flatnonzero(errors)[0])
+                raise laserball_exception.LaserballException("Invalid %s for point %s" % (parameter_grid.describe_errors(errors[i]), self.points[i]))
+            return
+        for point in self.points:
+            for setting in settings:
+                _encoders[setting](getattr(point, setting))
+
+    def axes(self):
+        """Settings ordered from most to least expensive to resend"""
+        return sorted(settings, key=setting_cost, reverse=True)
+
+    def order(self, method="nested", start=None):
+        """Reorder the points to reduce the settings resent.
+        nested: sort with the most expensive setting outermost, reversing
+        the inner settings on alternate passes so neighbouring points
+        differ in as few settings as possible.
+        greedy: repeatedly move to the cheapest next point, starting
+        from start (a Point, e.g. the current settings).  This is
+        quadratic in the number of points so suits small plans.
+        """
+        if method == "nested":
+            self.points = _snake(self.points, self.axes())
+        elif method == "greedy":
+            self.points = _greedy(self.points, start)
+        else:
+            raise ValueError("Unknown ordering: %s" % method)
+        return self
+
+    def cost(self, start=None):
+        """Number of settings resent and their cost in characters
+        if the plan is run from the start settings."""
+        n_sent = 0
+        cost = 0
+        previous = start
+        for point in self.points:
+            for setting in settings:
+                if previous is None or getattr(previous, setting) != getattr(point, setting):
+                    n_sent += 1
+                    cost += setting_cost(setting)
+            previous = point
+        return n_sent, cost
+
+    def execute(self, sc, wait=True, callback=None):
+        """Run the plan with a SerialCommand, firing once at each point.
+        If wait is True each sequence is finished before moving on.
+        callback(point, handle) is called after each fire.
+        Returns a list of (point, FireHandle).
+        """
+        self.validate()
+        results = []
+        for point in self.points:
+            # the changed settings go in a single write
+            sc.apply_settings(**point._asdict())
+            handle = sc.fire()
+            if wait:
+                sc.wait_fire(handle)
+            if callback is not None:
+                callback(point, handle)
+            results.append((point, handle))
+        return results
+
+
+def current_point(sc):
+    """The settings a SerialCommand currently holds, as a Point"""
+    return Point(**sc.settings())
+
+
+def _transition_cost(a, b):
+    cost = 0
+    for setting in settings:
+        if a is None or getattr(a, setting) != getattr(b, setting):
+            cost += setting_cost(setting)
+    return cost
+
+
+def _snake(points, axes):
+    if not axes or len(points) < 2:
+        return list(points)
+    groups = collections.defaultdict(list)
+    for point in points:
+        groups[getattr(point, axes[0])].append(point)
+    ordered = []
+    reverse = False
+    for value in sorted(groups):
+        group = _snake(groups[value], axes[1:])
+        if reverse:
+            group.reverse()
+        ordered.extend(group)
+        reverse = not reverse
+    return ordered
+
+
+def _greedy(points, start=None):
+    remaining = list(points)
+    ordered = []
+    previous = start
+    while remaining:
+        best = min(range(len(remaining)), key=lambda i: _transition_cost(previous, remaining[i]))
+        previous = remaining.pop(best)
+        ordered.append(previous)
+    return ordered
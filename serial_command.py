@@ -21,13 +21,19 @@
 ###########################################
 ###########################################
 
-import serial
+import collections
+import functools
+import math
 import laserball_exception
 #import re  Needed for temperature readout only (Not implemented)
 import sys
+import threading
 import time
+import weakref
 import laserball_logger
+import laserball_metrics
 import parameters
+from laserball_metrics import timed
 
 _max_pulse_height = 16383
 _max_pulse_width = 16383
@@ -55,14 +61,159 @@ _cmd_pd = "u" #Pulse delay
 #_cmd_temp_read = "T" not currently implemented
 
 _cmd_list = ["a","g","K","@","C","L","M","P","Q","R","S","H","G","u","T"]
+_cmd_set = frozenset(_cmd_list)
 
-class SerialCommand(object):
+#operand bytes following each command character.  The chip echoes every
+#byte, and repeats the command character once the command has all its
+#operands, apart from a channel clear.
+_operands = {"L": 1, "M": 1, "P": 0,
+             "Q": 1, "R": 2,
+             "H": 1, "G": 1,
+             "u": 2,
+             "C": 0, "g": 0, "a": 0, "@": 0}
+_no_repeat = [_cmd_channel_clear]
+
+#cache attribute changed by each command character
+_setting_attributes = {_cmd_ph_hi: "_current_ph", _cmd_ph_lo: "_current_ph", _cmd_ph_end: "_current_ph",
+                       _cmd_pw_hi: "_current_pw", _cmd_pw_lo: "_current_pw", _cmd_pw_end: "_current_pw",
+                       _cmd_pn_hi: "_current_pn", _cmd_pn_lo: "_current_pn",
+                       _cmd_pd: "_current_pd"}
+
+_bits_per_char = 10 #8 data bits plus start and stop bits on the wire
+
+#operations with their own deadline: reading a command echo, the stop
+#echo, an explicit read_buffer and reading out a buffer that was not clear
+_deadline_operations = ["echo", "stop", "read", "clear"]
+
+#time allowed beyond its expected length for a fire sequence to end
+_sequence_margin = 2.0
+
+
+def locked(method):
+    """Decorator running a SerialCommand method under its command lock,
+    opening the port first if needed"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._command_lock:
+            if self._serial is None:
+                self._connect()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SettingsCache(object):
+    """Settings and firing state the box is known to have, shared by
+    SerialCommand and async_command.AsyncSerialCommand.  A setting of
+    None is unknown."""
+
+    def __init__(self):
+        #cache current settings - remove need to re-command where possible
+        self._current_pw = None
+        self._current_ph = None
+        self._current_pn = None
+        self._current_pd = None
+        #information on whether the laserball is being fired
+        self._firing = False
+        self._firing_continuous = False
+        #if a new channel is selected should force setting all new parameters
+        #restriction only lifted once a fire command has been called
+        self._force_setting = False
+
+    def _cached(self, attribute, par):
+        """True if the box already has par for the setting, so it need
+        not be sent"""
+        return par == getattr(self, attribute) and not self._force_setting
+
+    def check_ready(self):
+        """Check that all settings have been set"""
+        not_set = []
+        if self._current_pw is None:
+            not_set += ["Pulse width"]
+        if self._current_ph is None:
+            not_set += ["Pulse height"]
+        if self._current_pn is None:
+            not_set += ["Pulse number"]
+        if self._current_pd is None:
+            not_set += ["Pulse delay"]
+        if not_set != []:
+            raise laserball_exception.LaserballException("Undefined options: %s" % (", ".join(opt for opt in not_set)))
+
+    def clear_settings(self):
+        """Clear settings all settings"""
+        self._current_pw = None
+        self._current_ph = None
+        self._current_pn = None
+        self._current_pd = None
+
+    def settings(self):
+        """The settings the box is known to have, as a dict of height,
+        width, number and delay (None if unknown)"""
+        return dict((name, getattr(self, attribute)) for name, attribute, encoder in _settings)
+
+    def get_pulse_height(self):
+        """Get the pulse height
+        """
+        return self._current_ph
+
+    def get_pulse_width(self):
+        """Get the pulse width
+        """
+        return self._current_pw
+
+    def get_pulse_delay(self):
+        """Get the pulse delay
+        """
+        return self._current_pd
+
+    def get_pulse_number(self):
+        """Get the pulse number
+        """
+        return self._current_pn
+
+    def is_firing(self):
+        """True while a fire sequence is running"""
+        return self._firing is True
+
+    def is_firing_continuous(self):
+        """True while firing in continuous mode"""
+        return self._firing_continuous is True
+
+
+class SerialCommand(SettingsCache):
     """Serial command object.
     Base class, different chips then inheret from this.
     """
 
-    def __init__(self, port_name=None):
-        """Initialise the serial command"""
+    def __init__(self, port_name=None, pipelined=True, device=None, metrics=None, record=None,
+                 state_store=None, state_key=None, baud_rate=2400, port_timeout=1.0,
+                 deadlines=None, adaptive=False, retries=2, retry_backoff=0.02, status=None,
+                 state_max_age=3600.):
+        """Initialise the serial command.
+        If pipelined is True each command group is written in one go and
+        the echo is read back as it arrives, rather than sleeping after
+        every write and waiting for the full port timeout.
+        device can be an already open pyserial-like object (e.g. a
+        serial_simulator.SimulatedSerial) to use instead of port_name.
+        metrics can be a laserball_metrics.Metrics to record timings and
+        counters in (see enable_metrics).
+        record can be a file name to record every byte written and read
+        to (see serial_session).
+        state_store can be a device_state.DeviceStateStore (or file name)
+        to keep the settings in between processes, under state_key
+        (default the port name).  Stored settings older than
+        state_max_age seconds (None for no limit) are not used.
+        deadlines can be a dict of operation: seconds allowed on top of
+        the time the link needs (see _deadline_operations), each
+        defaulting to port_timeout.  If adaptive is True the echo latency
+        is tracked and the allowances are tightened to suit it.
+        If a setting is not echoed correctly the link is resynchronised
+        and the setting sent again, up to retries times, waiting
+        retry_backoff seconds (doubling each time) in between.
+        status can be a status_block.StatusWriter (or file name) to
+        publish the settings, firing state, last command and error
+        counters to, for monitors to poll.
+        The port is not opened until the first command, or connect()."""
+        super(SerialCommand, self).__init__()
         if not port_name:
             self._port_name = "/dev/tty.usbserial-FTWWV9EA"
         else:
@@ -70,113 +221,487 @@ class SerialCommand(object):
         # This is the same as a sleep, but with the advantage of breaking
         # if enough characters are seen in the buffer.
         self._sleep = 0.005
+        self._pipelined = pipelined
+        if metrics is None:
+            metrics = laserball_metrics.null_metrics
+        self.metrics = metrics
 
-        self._port_timeout = 1
-        self._baud_rate = 2400
+        self._port_timeout = port_timeout
+        self._baud_rate = baud_rate
+        #time allowed on top of what the link needs, for each operation
+        self._deadlines = dict((operation, port_timeout) for operation in _deadline_operations)
+        if deadlines:
+            self.set_deadlines(**deadlines)
+        #retries of settings whose echo was wrong
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        #learns the echo latency, if adaptive
+        self.latency = None
+        if adaptive:
+            self.latency = LatencyTracker()
+        #the port is opened by connect()
         self._serial = None
-        self.logger = laserball_logger.LaserballLogger.get_instance()
-        try:
-            self._serial = serial.Serial(port=self._port_name, timeout=self._port_timeout, baudrate=self._baud_rate)
-            self.logger.debug("Serial connection open: %s" % self._serial)
-        except serial.SerialException, e:
-            raise laserball_exception.LaserballSerialException(e)
-        #cache current settings - remove need to re-command where possible
-        self._current_pw = [-999]*96
-        self._current_ph = [-999]*96
-        self._current_pn = None
-        self._current_pd = None
-        #information on whether the laserball is being fired
-        self._firing = 0 #must wait for firing to complete
-        self._firing_continuous = 0 #must wait for firing to complete
+        self._device = device
+        self._record = record
+        self._port_reader = None
+        self._logger = None
         self._reading = 0 #once a read command has been sent, dont send again!
-        #if a new channel is selected should force setting all new parameters
-        #restriction only lifted once a fire command has been called
-        self._force_setting = False
+        #completion handle for the last fire sequence
+        self._fire_handle = None
+        #one command at a time, from any number of threads
+        self._command_lock = threading.Lock()
+        #bytes that arrived when no reply was expected, as (time, data)
+        self.unexpected = collections.deque(maxlen=100)
+        #settings kept in between processes
+        if isinstance(state_store, str):
+            import device_state
+            state_store = device_state.DeviceStateStore(state_store)
+        self._state_store = state_store
+        self._state_key = state_key or self._port_name
+        self._state_max_age = state_max_age
+        #live state for monitors
+        if isinstance(status, str):
+            import status_block
+            status = status_block.StatusWriter(status)
+        self._status = status
         #send a reset, to ensure the RTS is set to false
         #self.reset()
 
 
     def __del__(self):
         """Deletion function"""
-        if self._serial:
+        self.close()
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            self._logger = laserball_logger.LaserballLogger.get_instance()
+        return self._logger
+
+    @logger.setter
+    def logger(self, logger):
+        self._logger = logger
+
+    def connect(self):
+        """Open the port, if it is not already open.  Commands connect
+        when first used, so this is only needed to open it early."""
+        with self._command_lock:
+            self._connect()
+
+    def _connect(self):
+        if self._serial is not None:
+            return
+        if self._device is not None:
+            port = self._device
+            #e.g. after close()
+            if not getattr(port, "is_open", True):
+                port.open()
+            self.logger.debug("Using serial device: %s", port)
+        else:
+            import serial
+            try:
+                port = serial.Serial(port=self._port_name, timeout=self._port_timeout, baudrate=self._baud_rate)
+            except serial.SerialException as e:
+                raise laserball_exception.LaserballSerialException(e)
+            self.logger.debug("Serial connection open: %s", port)
+        if self._record is not None:
+            import serial_session
+            port = serial_session.RecordingSerial(port, self._record)
+            self.logger.debug("Recording serial session: %s", self._record)
+        self._serial = port
+        #all reading from the port is done by this thread
+        self._port_reader = PortReader(self._serial, on_end=_end_sequence_callback(self),
+                                       poll=self._sleep, name="PortReader %s" % self._port_name)
+        self._port_reader.start()
+        if self._state_store is not None:
+            self._restore_state()
+        self._publish()
+
+    def is_connected(self):
+        return self._serial is not None
+
+    def close(self):
+        """Close the serial port.  The next command, or connect(),
+        opens it again."""
+        port_reader = getattr(self, "_port_reader", None)
+        if port_reader is not None:
+            port_reader.stop()
+        if getattr(self, "_serial", None):
             self._serial.close()
+        if port_reader is not None:
+            port_reader.join(self._port_timeout)
+        self._serial = None
+        self._port_reader = None
+        self._firing = False
+        self._firing_continuous = False
+        if getattr(self, "_fire_handle", None) is not None:
+            self._fire_handle._finish()
+        if getattr(self, "_status", None) is not None:
+            self._status.update(connected=False, firing=False, firing_continuous=False)
+
+    def _restore_state(self):
+        """Load the stored settings, if they are recent enough and the box
+        still responds.  A box that has been power cycled also responds,
+        with its settings lost, which cannot be detected: the maximum age
+        only limits how long that can go unnoticed."""
+        state = self._state_store.load(self._state_key)
+        if state is None:
+            return
+        age = time.time() - state.get("time", 0)
+        if self._state_max_age is not None and not 0 <= age <= self._state_max_age:
+            self.logger.log("Stored settings for %s are %.0f s old, ignoring them" % (self._port_name, age))
+            self._state_store.invalidate(self._state_key)
+            return
+        if not self._probe():
+            self.logger.warn("No response from %s, ignoring stored settings", self._port_name)
+            self._state_store.invalidate(self._state_key)
+            return
+        self._current_ph = state.get("height")
+        self._current_pw = state.get("width")
+        self._current_pn = state.get("number")
+        self._current_pd = state.get("delay")
+        self.metrics.count("state_restored")
+        self.logger.debug("Restored settings: %s", state)
+
+    def _save_state(self):
+        """Store the current settings, once they have been confirmed,
+        and publish them"""
+        self._publish()
+        if self._state_store is None or self._firing is True or self._firing_continuous is True:
+            return
+        self._state_store.save(self._state_key, **self.settings())
+
+    def _count(self, name, n=1):
+        """Count an event in the metrics and the status block (name must
+        be one of status_block.counters)"""
+        self.metrics.count(name, n)
+        if self._status is not None:
+            self._status.count(name, n)
+
+    def _publish(self, command=None):
+        """Update the status block, if there is one, with the current
+        state and the last command sent"""
+        if self._status is None:
+            return
+        values = self.settings()
+        if command is not None:
+            values["last_command"] = command
+            values["last_command_time"] = time.time()
+        self._status.update(firing=self.is_firing(), firing_continuous=self.is_firing_continuous(),
+                            connected=self._serial is not None, **values)
+
+    def _probe(self):
+        """Check that the box responds, by sending a stop and reading
+        back its echo"""
+        try:
+            self._check_clear_buffer()
+            self._send_command(_cmd_stop, buffer_check=_cmd_stop)
+        except laserball_exception.LaserballException as e:
+            self.logger.debug("Probe failed: %s", e)
+            return False
+        return True
+
+    def set_deadlines(self, **deadlines):
+        """Set the time allowed for operations, e.g. set_deadlines(echo=0.5)"""
+        for operation, seconds in deadlines.items():
+            if operation not in _deadline_operations:
+                raise laserball_exception.LaserballException("Unknown operation: %s" % operation)
+            self._deadlines[operation] = seconds
+
+    def _allowance(self, operation):
+        """Time allowed for an operation on top of what the link needs"""
+        allowance = self._deadlines[operation]
+        if self.latency is not None:
+            allowance = self.latency.allowance(allowance)
+        return allowance
+
+    def enable_metrics(self, metrics=None):
+        """Start recording metrics, returns the Metrics object"""
+        if metrics is None:
+            metrics = laserball_metrics.Metrics()
+        self.metrics = metrics
+        return metrics
+
+    def disable_metrics(self):
+        self.metrics = laserball_metrics.null_metrics
+
+    def _write(self, data):
+        #the reader must know the echo is due before it can arrive, which
+        #is at most twice as long as the data
+        self._port_reader.expect(data, 3 * len(data) * self._char_time() +
+                                 len(data) * self._sleep + self._allowance("echo"))
+        if not isinstance(data, bytes):
+            #pyserial on python 3 only takes bytes
+            data = data.encode("latin-1")
+        self._serial.write(data)
+        if self.metrics.enabled:
+            self.metrics.count("bytes_written", len(data))
+
+    def _take(self, n=None):
+        """Take up to n (default all) characters read by the port reader"""
+        buffer_read = self._port_reader.take(n)
+        if buffer_read and self.metrics.enabled:
+            self.metrics.count("bytes_read", len(buffer_read))
+        return buffer_read
+
+    def _record_unexpected(self, data):
+        """Keep bytes that were not part of any reply"""
+        data = data.replace(_buffer_end_sequence, "")
+        if data:
+            self.unexpected.append((time.time(), data))
+            self._count("unexpected_bytes", len(data))
+            self.logger.debug("Unexpected bytes: %r", data)
 
     def _check_clear_buffer(self):
         """Many commands expect an empty buffer, fail if they are not!
+        Returns straight away if nothing is waiting, otherwise reads until
+        the line goes quiet.
         """
-        buffer_read = self._serial.read(100)
-        if "K" in buffer_read:
-            self._firing = False
-            self._firing_continuous = False
+        buffer_read = self._drain()
+        if buffer_read:
+            buffer_read += self._read_quiet(100, self._allowance("clear"), wait_first=False)
+            if self._firing is not True and self._firing_continuous is not True:
+                self._record_unexpected(buffer_read)
         return buffer_read
 
         #if buffer_read != "":
         #    raise laserball_exception.LaserballException("Buffer not clear: %s" % (buffer_read))
 
-    def _send_command(self, command, readout=True, buffer_check=None):
+    def _drain(self):
+        """Take whatever has been read without blocking"""
+        return self._take()
+
+    def _read_quiet(self, n, timeout, wait_first=True):
+        """Read up to n characters.  Returns after timeout, or once the
+        line has been quiet for a few character times after the last
+        character (or from the start if not wait_first)."""
+        buffer_read = ''
+        now = time.time()
+        end = now + timeout
+        last = None if wait_first else now
+        quiet = 2 * self._char_time() + self._sleep
+        while len(buffer_read) < n:
+            data = self._take(n - len(buffer_read))
+            if data:
+                buffer_read += data
+                last = time.time()
+                continue
+            now = time.time()
+            until = end
+            if last is not None:
+                until = min(until, last + quiet)
+            if now >= until:
+                break
+            self._port_reader.wait_data(until - now)
+        return buffer_read
+
+    @timed("_send_command")
+    def _send_command(self, command, readout=True, buffer_check=None, retries=0, strict=True):
         """Send a command to the serial port.
         Command can be a chr/str (single write) or a list.
         Lists are used for e.g. a high/low bit command where
-        the high bit could finish with an endline (i.e. endstream)"""
-        self.logger.debug("_send_command:%s" % command)
-        buffer_check_full = ''
-        if type(command) is str:
-            command = [command]
-        if type(command) is not list:
-            raise laserball_exception.LaserballException("Command is not a list: %s %s" % (command, type(command)))
+        the high bit could finish with an endline (i.e. endstream).
+        Can also be a CompiledCommand.
+        If the echo is wrong the cached settings the command changes are
+        forgotten and the link is resynchronised; commands that are safe
+        to repeat can then be sent again up to retries times, with a
+        backoff, before giving up.  If not strict, command characters
+        other than the echo (e.g. from readout while firing) are skipped."""
+        if type(command) is not CompiledCommand:
+            command = compile_command(command)
+        self.logger.debug("_send_command:%s", command.command)
+        # a caller expecting the end of sequence marker can wait for it
+        wait_end = buffer_check is not None and buffer_check.endswith(_buffer_end_sequence)
+        self._count("commands")
         try:
-            for c in command:
-                if c == "C":
-                    buffer_check_full = c
-                else:
-                    buffer_check_full += c+c[:1]
-                self._serial.write(c)
-                time.sleep(0.1)        
+            attempt = 0
+            start = None
+            while True:
+                parser = self._send_once(command, readout, wait_end, strict)
+                if readout is not True:
+                    self.logger.debug("not a readout command")
+                    return
+                # garbage has been separated out by the parser, as has any end
+                # of sequence that is not part of the echo
+                if parser.success():
+                    break
+                self._count("echo_mismatches")
+                self.logger.debug("problem reading buffer, send %s, read %s,", command.command, parser.raw)
+                if start is None:
+                    start = time.time()
+                self._invalidate_settings(command.buffer_check)
+                remainder = self._resync()
+                if attempt >= retries:
+                    if retries:
+                        self.metrics.count("retry_failures")
+                    message = "Unexpected buffer output:\nsaw: %s, remainder %s,\nexpected: %s" % (parser.echo, remainder, command.buffer_check)
+                    self.logger.warn(message)
+                    raise laserball_exception.LaserballException(message)
+                attempt += 1
+                self._count("retries")
+                self.logger.warn("Echo mismatch, saw %r expected %r, retry %d of %d",
+                                 parser.echo, command.buffer_check, attempt, retries)
+                time.sleep(self._retry_backoff * 2 ** (attempt - 1))
+            if attempt:
+                self.metrics.count("recoveries")
+                self.metrics.add_time("recovery", time.time() - start)
+                self.logger.log("Recovered after %d retries" % attempt)
+            self.logger.debug("success reading buffer:%s", parser.echo)
+        except laserball_exception.LaserballException:
+            self._count("command_errors")
+            raise
+        finally:
+            self._publish(command.buffer_check)
+
+    def _send_once(self, command, readout, wait_end, strict=True):
+        """Write a CompiledCommand and, if readout, read back its echo.
+        Returns the EchoParser (None if not readout)."""
+        if self._pipelined:
+            return self._send_pipelined(command, readout, wait_end, strict)
+        try:
+            for c in command.command:
+                self._write(c)
+                time.sleep(0.1)
         except:
             raise laserball_exception.LaserballException("Lost connection with Laserball control!")
-        buffer_check = ''
-        for c in buffer_check_full:
-            if c in _cmd_list:
-                buffer_check += c
-        if readout is True:
-            # One read command (with default timeout of 0.1s) should be
-            # enough to get all the chars from the readout.
-            # buffer contains charchters which are garbage following is to remove
-            buffer_read = ''
-            buffer_read_full = self.read_buffer()
-            for c in buffer_read_full:
-                if c in _cmd_list:
-                    buffer_read += c
-            buffer_check_2 = ''
-            if buffer_check== 'gg':
-                buffer_check_2 = 'ggK'
-            if len(buffer_read_full) > len(buffer_check) + 2:
-                self.logger.debug("problem reading buffer, send %s, read %s," % (command, buffer_read_full))
-                #clear anything else that might be in there
-                time.sleep(0.1)
-                remainder = self._serial.read(100)
-                self._serial.write("@") # send a stop
-                time.sleep(0.1)
-                self._serial.read(100)
-                message = "Unexpected buffer output:\nsaw: %s, remainder %s,\nexpected: %s" % (buffer_read_full, remainder, buffer_check)
-                self.logger.warn(message)
-                raise laserball_exception.LaserballException(message)
-            elif str(buffer_read)!=str(buffer_check) and str(buffer_read) != str(buffer_check_2) :
-                self.logger.debug("problem reading buffer, send %s, read %s," % (command, buffer_read))
-                #clear anything else that might be in there
-                time.sleep(0.1)
-                remainder = self._serial.read(100)
-                self._serial.write("@") # send a stop
-                time.sleep(0.1)
-                self._serial.read(100)
-                message = "Unexpected buffer output:\nsaw: %s, remainder %s,\nexpected: %s" % (buffer_read, remainder, buffer_check)
-                self.logger.warn(message)
-                raise laserball_exception.LaserballException(message)
-            else:
-                self.logger.debug("success reading buffer:%s" % buffer_read)
+        if readout is not True:
+            return None
+        # One read command (with default timeout of 0.1s) should be
+        # enough to get all the chars from the readout.
+        parser = EchoParser(command.buffer_check, strict=strict)
+        parser.feed(self._read_quiet(100, self._allowance("read")))
+        return parser
+
+    def _invalidate_settings(self, echo):
+        """Forget the cached settings changed by a command with this
+        echo, as the box may or may not have taken them"""
+        if _cmd_channel_clear in echo:
+            attributes = set(_setting_attributes.values())
         else:
-            self.logger.debug("not a readout command")
+            attributes = set(_setting_attributes[c] for c in echo if c in _setting_attributes)
+        for attribute in attributes:
+            setattr(self, attribute, None)
+        if attributes:
+            self._save_state()
+
+    def _resync(self):
+        """Bring the link back into step after a bad echo: read until the
+        line goes quiet, then send stops until one is echoed (unless
+        firing, which a stop would end).  Returns what was read first."""
+        start = time.time()
+        self._count("resyncs")
+        remainder = self._read_quiet(100, self._allowance("clear"), wait_first=False)
+        self._port_reader.forget()
+        if not (self.is_firing() or self.is_firing_continuous()):
+            try:
+                self._wait_ready(time.time() + self._allowance("stop"))
+            except laserball_exception.LaserballException:
+                self.metrics.count("resync_failures")
+                self.logger.warn("Could not resynchronise with %s", self._port_name)
+        self.metrics.add_time("resync", time.time() - start)
+        return remainder
+
+    def _send_pipelined(self, command, readout, wait_end=False, strict=True):
+        """Write a CompiledCommand in a single write and read back the echo.
+        Reading stops as soon as the echo is complete (or wrong), or once
+        the deadline derived from the link speed has passed.  Returns the
+        EchoParser.
+        """
+        data = command.data
+        try:
+            self._write(data)
+        except:
+            raise laserball_exception.LaserballException("Lost connection with Laserball control!")
+        if readout is not True:
+            return None
+        parser = EchoParser(command.buffer_check, wait_end, strict)
+        # time to clock the command out and the echo back, plus the firmware
+        # processing time for each command in the group
+        expected_time = (len(data) + len(command.buffer_check) + 1) * self._char_time() + len(command.command) * self._sleep
+        if wait_end:
+            expected_time += self._sequence_time()
+        start = time.time()
+        self._read_echo(parser, start + expected_time + self._allowance("echo"))
+        if self.latency is not None:
+            if parser.success():
+                self.latency.observe(time.time() - start - expected_time)
+            elif not parser.complete():
+                #ran out of time, go back to the configured deadlines
+                self.latency.expired()
+        return parser
+
+    def _read_echo(self, parser, deadline):
+        """Feed the parser as characters arrive until it is complete or
+        the deadline passes.  Returns the parser.
+        """
+        while not parser.complete():
+            data = self._take()
+            if data:
+                parser.feed(data)
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._port_reader.wait_data(remaining)
+        if not parser.complete():
+            self._count("echo_timeouts")
+        return parser
+
+    def _end_sequence(self, error=None):
+        """Called by the port reader when the end of sequence arrives"""
+        self._firing = False
+        self._firing_continuous = False
+        if self._fire_handle is not None:
+            self._fire_handle._finish(error)
+        self._publish()
+
+    def _wait_sequence(self):
+        """Wait for the current fire sequence to finish.  Must be called
+        holding the command lock, which is released while waiting."""
+        if self._firing is not True:
+            return
+        self.logger.log("Still firing... waiting for sequence to finish")
+        start = time.time()
+        while self._firing is True and self._fire_handle is not None:
+            handle = self._fire_handle
+            self._command_lock.release()
+            try:
+                handle.wait()
+            finally:
+                self._command_lock.acquire()
+        self.metrics.add_time("wait_end_sequence", time.time() - start)
+
+    def wait_sequence(self, timeout=None):
+        """Wait for the current fire sequence to finish, returns False
+        on timeout"""
+        handle = self._fire_handle
+        if self._firing is not True or handle is None:
+            return True
+        return handle.wait(timeout)
+
+    def wait_fire(self, handle, margin=_sequence_margin):
+        """Wait for the sequence of a FireHandle to finish, allowing its
+        expected time plus margin seconds.  If it has not finished by
+        then its end of sequence has been lost: the box is stopped and
+        LaserballException raised, rather than waiting forever."""
+        timeout = handle.expected_time + margin
+        if not handle.wait(timeout):
+            self.logger.warn("No end of sequence after %.1f s, stopping", timeout)
+            self.stop()
+            raise laserball_exception.LaserballException("Sequence not finished after %.1f s" % timeout)
+        return handle
+
+    def _char_time(self):
+        """Time taken to send one character at the current baud rate"""
+        return float(_bits_per_char) / self._baud_rate
+
+    def _sequence_time(self):
+        """Expected length of a fire sequence in seconds"""
+        if self._current_pn is None or self._current_pd is None:
+            return 0.
+        return self._current_pn * quantise_pulse_delay(self._current_pd) / 1000.
 
+    @timed("_send_setting_command")
     def _send_setting_command(self, command, buffer_check=None, while_fire=False):
         """Send non-firing command.
         All of these should have a clear buffer before being used.  Can set
@@ -187,155 +712,265 @@ class SerialCommand(object):
         if self._firing_continuous is True and while_fire is False:
             raise laserball_exception.LaserballException("Cannot fire, already in continuous firing mode")
         if self._firing is True and while_fire is False:
-            while "K" not in str(self.read_buffer()):
-                print "Still firing... waiting for sequence to finish"
-                time.sleep(1)
-            self._firing = False
-        if self._firing is True:
+            self._wait_sequence()
+        if self._firing is True or self._firing_continuous is True:
             if while_fire is False:
                 raise laserball_exception.LaserballException("Cannot run command, in firing mode")
             else:
-                #Assume that we CANNOT readout the buffer here!
-                self._send_command(command=command, readout=False)
+                #the buffer may hold PIN readout as well as the echo, so
+                #only the echoed command characters are checked
+                self._drain()
+                self._send_command(command=command, buffer_check=buffer_check,
+                                   retries=self._retries, strict=False)
         else:
             self._check_clear_buffer()
-            self._send_command(command=command, buffer_check=buffer_check)
+            #settings can safely be sent again if the echo is wrong
+            self._send_command(command=command, buffer_check=buffer_check, retries=self._retries)
 
-    def reset(self):
+    @locked
+    def reset(self, hold=3.0, timeout=6.0):
         """Send a reset command!
 
-        Assumes that the port is open (which it is by default)
+        RTS is held for hold seconds.  Once released, and anything the
+        box sends while booting has stopped, it is polled with stop
+        commands until it echoes one, for up to timeout seconds.
         """
         self.logger.debug("Reset!")
         self._serial.setRTS(True)
-        # sleep, just in case
-        time.sleep(3.0)
+        time.sleep(hold)
         self._serial.setRTS(False)
-        # close the port and reopen?
-        time.sleep(3.0)
+        start = time.time()
+        self._firing = False
+        self._firing_continuous = False
+        #the box has lost its settings
+        self.clear_settings()
+        deadline = start + timeout
+        while self._read_quiet(100, max(deadline - time.time(), 0.), wait_first=False):
+            if time.time() >= deadline:
+                break
+        self._wait_ready(deadline)
+        self._check_clear_buffer()
+        self.metrics.add_time("reset_ready", time.time() - start)
 
+    def _wait_ready(self, deadline):
+        """Send stops until one is echoed, raises LaserballException if
+        none is by the deadline.  The echoes still due for the stops that
+        went unanswered are forgotten once one is echoed."""
+        expected = expected_echo([_cmd_stop])
+        wait = 2 * len(expected) * self._char_time() + 2 * self._sleep
+        while True:
+            self._take()
+            self._write(_cmd_stop)
+            parser = EchoParser(expected, strict=False)
+            self._read_echo(parser, min(time.time() + wait, deadline))
+            if parser.success():
+                self._port_reader.forget()
+                return
+            if time.time() >= deadline:
+                raise laserball_exception.LaserballException("No response from %s after reset" % self._port_name)
 
+
+    @timed("fire")
+    @locked
     def fire(self, while_fire=False):
         """Fire laserball, place class into firing mode.
-        Can send a fire command while already in fire mode if required."""
+        Can send a fire command while already in fire mode if required.
+        Returns a FireHandle that completes once the sequence has finished,
+        so that other work can be done while firing."""
         self.logger.debug("Fire!") 
         if self._firing_continuous is True and while_fire is False:
             raise laserball_exception.LaserballException("Cannot fire, already in continuous firing mode")
         if self._firing is True and while_fire is False:
-            while "K" not in str(self.read_buffer()):
-                print "Still firing... waiting for sequence to finish"
-                time.sleep(1)
-            self._firing = False
+            self._wait_sequence()
         self.check_ready()
-        cmd = None
-        buffer_check = _cmd_fire_series
-        #if the series is less than 0.5 seconds, also check for the end of sequence
-        if (self._current_pn * self._current_pd) < 500:
-            buffer_check += _buffer_end_sequence
-            self._send_command(_cmd_fire_series, buffer_check=buffer_check)
-        else:
-            self._send_command(_cmd_fire_series, buffer_check=buffer_check)
-            self._firing = True #still firing
+        if self._fire_handle is not None:
+            #a new sequence replaces any that is running
+            self._fire_handle._finish()
+        handle = FireHandle(self._sequence_time())
+        self._fire_handle = handle
+        self._firing = True #cleared when the end of sequence is read
+        #echoes of commands sent while firing are not part of the reply
+        self._check_clear_buffer()
+        #only the echo is read, however short the sequence: the port
+        #reader finishes the handle when the end of sequence arrives
+        try:
+            self._send_command(_cmd_fire_series)
+        except laserball_exception.LaserballException as e:
+            self._firing = False
+            handle._finish(e)
+            raise
         self._force_setting = False
+        return handle
 
-    def fire_continuous(self):
+    @locked
+    def fire_continuous(self, while_fire=False):
         """Fire Laserball in continous mode.
+        The pulse width can be changed while firing, see
+        continuous_session.ContinuousSession to stream updates.
         """
         if self._firing_continuous is True and while_fire is False:
             raise laserball_exception.LaserballException("Cannot fire, already in continuous firing mode")
         if self._firing is True and while_fire is False:
-            while "K" not in str(self.read_buffer()):
-                print "Still firing... waiting for sequence to finish"
-                time.sleep(1)
-            self._firing = False
+            self._wait_sequence()
         self._send_command(_cmd_fire_continuous, False)
         self._firing_continuous = True
         self._force_setting = False
+        self._publish()
 
+    @timed("read_buffer")
+    @locked
     def read_buffer(self, n=100):
-        buffer = self._serial.read(n)
-        if "K" in buffer:
-            self._firing = False
-            self._firing_continuous = False
-        return buffer
+        """Read up to n characters, waiting until the line goes quiet"""
+        return self._read_quiet(n, self._allowance("read"))
 
+    @timed("stop")
+    @locked
     def stop(self):
         """Stop firing laserball"""
         self.logger.debug("Stop firing!")
-        self._send_command(_cmd_stop, False)
-        buffer_contents = self.read_buffer()
+        if self._pipelined:
+            buffer_contents = self._check_clear_buffer()
+            self._send_command(_cmd_stop, False)
+            #read the echo, and the end of sequence if still firing.  Echoes
+            #of commands sent while firing may still be arriving first.
+            firing = self._firing is True or self._firing_continuous is True
+            parser = EchoParser(expected_echo([_cmd_stop]), wait_end=firing, strict=False)
+            deadline = time.time() + 2 * len(parser.expected) * self._char_time() + self._sleep + self._allowance("stop")
+            buffer_contents += self._read_echo(parser, deadline).raw
+        else:
+            self._send_command(_cmd_stop, False)
+            buffer_contents = self._read_quiet(100, self._allowance("read"))
         self._firing = False
+        self._firing_continuous = False
+        if self._fire_handle is not None:
+            self._fire_handle._finish()
+        self._save_state()
         return buffer_contents
 
-    def check_ready(self):
-        """Check that all settings have been set"""
-        not_set = []
-        if self._current_pw is None:
-            not_set += ["Pulse width"]
-        if self._current_ph is None:
-            not_set += ["Pulse height"]
-        if self._current_pn is None:
-            not_set += ["Pulse number"]
-        if self._current_pd is None:
-            not_set += ["Pulse delay"]
-        if not_set != []:
-            raise laserball_exception.LaserballException("Undefined options: %s" % (", ".join(opt for opt in not_set)))
-
+    @locked
     def clear_channel(self):
         """Unselect the channel"""
         self.logger.debug("Clear channel")
-        self._send_command(_cmd_channel_clear, buffer_check=_cmd_channel_clear)
+        self._send_command(_cmd_channel_clear, buffer_check=_cmd_channel_clear, retries=self._retries)
+        self._force_setting = True
+        self.clear_settings()
 
     def clear_settings(self):
         """Clear settings all settings"""
-        self._current_pw = None
-        self._current_ph = None
-        self._current_pn = None
-        self._current_pd = None
+        super(SerialCommand, self).clear_settings()
+        if self._state_store is not None:
+            self._state_store.invalidate(self._state_key)
+        self._publish()
 
+    @locked
     def set_pulse_height(self, par):
         """Set the pulse height for the laserball"""
-        if par == self._current_ph and not self._force_setting:
-            pass #same as current setting
+        if self._cached("_current_ph", par):
+            self.metrics.count("height_cached") #same as current setting
         else:
-            self.logger.debug("Set pulse height %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_height(par)
-            self._send_setting_command(command=command, buffer_check=buffer_check)
+            self.metrics.count("height_sent")
+            self.logger.debug("Set pulse height %s %s", par, type(par))
+            command = compiled_command(command_pulse_height, par)
+            self._send_setting_command(command=command, buffer_check=command.buffer_check)
             self._current_ph = par
+            self._save_state()
 
+    @locked
     def set_pulse_width(self, par, while_fire=False):
         """Set the pulse width for the selected channel.
         This is the only setting that can be modified while in firing mode."""
-        if par == self._current_pw and not self._force_setting:
-            pass #same as current setting
+        if self._cached("_current_pw", par):
+            self.metrics.count("width_cached") #same as current setting
         else:
-            self.logger.debug("Set pulse width %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_width(par)
-            if while_fire and self._firing:
-                self._send_setting_command(command=command, while_fire=while_fire)
+            self.metrics.count("width_sent")
+            self.logger.debug("Set pulse width %s %s", par, type(par))
+            command = compiled_command(command_pulse_width, par)
+            if while_fire and (self._firing or self._firing_continuous):
+                self._send_setting_command(command=command, buffer_check=command.buffer_check,
+                                           while_fire=while_fire)
             else:
-                self._send_setting_command(command=command, buffer_check=buffer_check)
+                self._send_setting_command(command=command, buffer_check=command.buffer_check)
             self._current_pw = par
+            self._save_state()
 
+    @locked
     def set_pulse_number(self, par):
         """Set the number of pulses to fire (global setting)"""
-        if par == self._current_pn and not self._force_setting:
-            pass
+        if self._cached("_current_pn", par):
+            self.metrics.count("number_cached")
         else:
-            self.logger.debug("Set pulse number %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_number(par)
-            self._send_setting_command(command=command, buffer_check=buffer_check)
+            self.metrics.count("number_sent")
+            self.logger.debug("Set pulse number %s %s", par, type(par))
+            command = compiled_command(command_pulse_number, par)
+            self._send_setting_command(command=command, buffer_check=command.buffer_check)
             self._current_pn = par
+            self._save_state()
 
+    @locked
     def set_pulse_delay(self, par):
         """Set the delay between pulses (global setting)"""
-        if par == self._current_pd and not self._force_setting:
-            pass
+        if self._cached("_current_pd", par):
+            self.metrics.count("delay_cached")
         else:
-            self.logger.debug("Set pulse delay %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_delay(par)
-            self._send_setting_command(command=command, buffer_check=buffer_check)
+            self.metrics.count("delay_sent")
+            self.logger.debug("Set pulse delay %s %s", par, type(par))
+            command = compiled_command(command_pulse_delay, par)
+            self._send_setting_command(command=command, buffer_check=command.buffer_check)
             self._current_pd = par
+            self._save_state()
+
+    @timed("apply_settings")
+    @locked
+    def apply_settings(self, height=None, width=None, number=None, delay=None):
+        """Set several settings in one go.  Settings left as None, and
+        those already held, are skipped; the rest are sent in a single
+        write and their combined echo checked once.  The cache is only
+        updated if every setting was accepted.  Returns the names of the
+        settings sent."""
+        values = {"height": height, "width": width, "number": number, "delay": delay}
+        names = []
+        commands = []
+        for name, attribute, encoder in _settings:
+            par = values[name]
+            if par is None:
+                continue
+            if self._cached(attribute, par):
+                self.metrics.count(name + "_cached")
+                continue
+            # every value is checked before anything is sent
+            commands.append(compiled_command(encoder, par))
+            names.append(name)
+        if not commands:
+            return names
+        for name in names:
+            self.metrics.count(name + "_sent")
+        self.logger.debug("Apply settings %s", ", ".join("%s %s" % (name, values[name]) for name in names))
+        command = CompiledCommand(sum((c.command for c in commands), []),
+                                  "".join(c.data for c in commands),
+                                  "".join(c.buffer_check for c in commands))
+        try:
+            self._send_setting_command(command=command, buffer_check=command.buffer_check)
+        except:
+            #some of the settings may have been taken
+            for name, attribute, encoder in _settings:
+                if name in names:
+                    setattr(self, attribute, None)
+            raise
+        for name, attribute, encoder in _settings:
+            if name in names:
+                setattr(self, attribute, values[name])
+        self._save_state()
+        return names
+
+    def transaction(self):
+        """Collect settings and send them together with apply_settings,
+        at the end of a with block (unless it raises):
+
+        with sc.transaction() as t:
+            t.set_pulse_height(8000)
+            t.set_pulse_width(100)
+        """
+        return SettingsTransaction(self)
 
     ##################################
     #Temperature module not yet implemented
@@ -358,22 +993,455 @@ class SerialCommand(object):
     #    temp = float(temp[0])
     #    return temp
     #
-    ########################################
-    # Commands just to check current settings
-    def get_pulse_delay(self):
-        """Get the pulse delay
-        """
-        return self._current_pd
 
-    def get_pulse_number(self):
-        """Get the pulse delay
-        """
-        return self._current_pn
+def _end_sequence_callback(sc):
+    """End of sequence callback for a PortReader, holding only a weak
+    reference so the SerialCommand can still be deleted"""
+    ref = weakref.ref(sc)
+
+    def on_end(error=None):
+        sc = ref()
+        if sc is not None:
+            if error is not None:
+                sc.logger.warn("Lost connection: %s", error)
+            sc._end_sequence(error)
+    return on_end
+
+
+class PortReader(object):
+    """Thread that does all the reading from a port.
+
+    Everything read goes into a ring buffer (the oldest characters are
+    dropped, and counted, if it fills) for the command methods to take,
+    waiting on a condition rather than polling the port.  on_end is
+    called from the thread whenever an end of sequence arrives, and
+    with the error if the port fails.
+
+    Everything written must first be registered with expect(), so that
+    an end of sequence character in its echo is not taken for the end of
+    a sequence (see PendingEchoes).
+    """
+
+    def __init__(self, device, on_end=None, size=4096, poll=0.005, name="PortReader"):
+        self._device = device
+        self._on_end = on_end
+        self._poll = poll
+        self._buffer = collections.deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self.received = 0
+        self.dropped = 0
+        self.ends = 0
+        self.error = None
+        self.echoes = PendingEchoes()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def take(self, n=None):
+        """Take up to n (default all) buffered characters"""
+        with self._cond:
+            if n is None or n >= len(self._buffer):
+                data = "".join(self._buffer)
+                self._buffer.clear()
+            else:
+                data = "".join(self._buffer.popleft() for i in range(n))
+        return data
+
+    def waiting(self):
+        return len(self._buffer)
+
+    def expect(self, data, timeout):
+        """Register data about to be written, its echo due within
+        timeout seconds"""
+        with self._cond:
+            self.echoes.expect(data, timeout)
+
+    def forget(self):
+        """Forget the echoes due, once the line is known to be quiet"""
+        with self._cond:
+            self.echoes.forget()
+
+    def wait_data(self, timeout):
+        """Wait up to timeout for buffered characters, returns True if
+        there are any.  Waits at most the poll time, as timed waits in
+        python 2 sleep for longer and longer between checks."""
+        with self._cond:
+            if not self._buffer and not self._stop.is_set():
+                self._cond.wait(min(timeout, self._poll))
+            return len(self._buffer) > 0
+
+    def _run(self):
+        device = self._device
+        while not self._stop.is_set():
+            try:
+                waiting = device.inWaiting()
+                if waiting:
+                    data = device.read(waiting)
+                else:
+                    # blocks until a character arrives or the port times out
+                    data = device.read(1)
+                    if data:
+                        waiting = device.inWaiting()
+                        if waiting:
+                            data += device.read(waiting)
+            except Exception as e:
+                if not self._stop.is_set():
+                    self.error = e
+                    if self._on_end is not None:
+                        self._on_end(e)
+                with self._cond:
+                    self._cond.notify_all()
+                return
+            if not data:
+                # devices that do not block on read
+                time.sleep(self._poll)
+                continue
+            if not isinstance(data, str):
+                data = data.decode("latin-1")
+            with self._cond:
+                overflow = len(self._buffer) + len(data) - self._buffer.maxlen
+                if overflow > 0:
+                    self.dropped += overflow
+                self._buffer.extend(data)
+                self.received += len(data)
+                ends = self.echoes.ends(data)
+                self.ends += ends
+                self._cond.notify_all()
+            if ends and self._on_end is not None:
+                self._on_end()
+
+
+class PendingEchoes(object):
+    """Echoes the control chip still owes for what has been written.
+
+    The end of sequence character can also be an operand byte (e.g. a
+    pulse width lo byte of 75), which the chip echoes.  Characters read
+    are matched against the echoes due, in order, and only an end of
+    sequence that is not part of one is an end.  An echo that has not
+    arrived by its deadline is forgotten.  Not thread safe.
+    """
+
+    def __init__(self):
+        #echoes due, as [echo, characters matched, deadline]
+        self._expected = collections.deque()
+        #command split across writes, see raw_echo
+        self._pending = [None, 0]
+        self.expired = 0
+
+    def expect(self, data, timeout):
+        """Register data about to be written"""
+        echo = raw_echo(data, self._pending)
+        if echo:
+            self._expected.append([echo, 0, time.time() + timeout])
+
+    def forget(self):
+        self._expected.clear()
+        self._pending = [None, 0]
+
+    def ends(self, data):
+        """Number of end of sequence characters in data read that are
+        not part of an echo"""
+        expected = self._expected
+        now = time.time()
+        while expected and expected[0][2] < now:
+            expected.popleft()
+            self.expired += 1
+        ends = 0
+        for c in data:
+            if expected and expected[0][0][expected[0][1]] == c:
+                expected[0][1] += 1
+                if expected[0][1] == len(expected[0][0]):
+                    expected.popleft()
+            elif c == _buffer_end_sequence:
+                ends += 1
+        return ends
+
+
+class LatencyTracker(object):
+    """Running record of the echo latency beyond what the link speed
+    accounts for.  Once enough samples are seen, allowances are set to
+    a high percentile of the recent latencies times a safety margin
+    (never more than the configured deadline).
+    """
+
+    def __init__(self, size=200, percentile=99., margin=2., minimum=0.05, warmup=20):
+        self.percentile = percentile
+        self.margin = margin
+        self.minimum = minimum
+        self.warmup = warmup
+        self._samples = collections.deque(maxlen=size)
+        self._value = None
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        with self._lock:
+            self._samples.append(max(latency, 0.))
+            self._value = None
+
+    def expired(self):
+        """An operation ran out of time: forget the samples, so the
+        configured deadlines apply until enough are seen again"""
+        with self._lock:
+            self._samples.clear()
+            self._value = None
+
+    def latency(self):
+        """The percentile latency, or None until warmed up"""
+        with self._lock:
+            if len(self._samples) < self.warmup:
+                return None
+            if self._value is None:
+                ordered = sorted(self._samples)
+                index = int(math.ceil(self.percentile / 100. * len(ordered))) - 1
+                self._value = ordered[min(max(index, 0), len(ordered) - 1)]
+            return self._value
+
+    def median(self):
+        """The median latency, or None if nothing has been seen"""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[len(ordered) // 2]
+
+    def allowance(self, default):
+        value = self.latency()
+        if value is None:
+            return default
+        return min(default, max(self.minimum, value * self.margin))
+
+
+class SettingsTransaction(object):
+    """Settings to apply together, see SerialCommand.transaction"""
+
+    def __init__(self, sc):
+        self._sc = sc
+        self.values = {}
+        self.sent = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.values = {}
+
+    def set_pulse_height(self, par):
+        self.values["height"] = par
+
+    def set_pulse_width(self, par):
+        self.values["width"] = par
+
+    def set_pulse_number(self, par):
+        self.values["number"] = par
+
+    def set_pulse_delay(self, par):
+        self.values["delay"] = par
+
+    def commit(self):
+        """Send the collected settings, returns the names sent"""
+        values = self.values
+        self.values = {}
+        self.sent = self._sc.apply_settings(**values)
+        return self.sent
+
+
+class FireHandle(object):
+    """Completion handle for a fire sequence, returned by
+    SerialCommand.fire.  Completes when the end of sequence is seen,
+    the laserball is stopped or the sequence is replaced by another.
+    """
+
+    def __init__(self, expected_time):
+        self.expected_time = expected_time
+        self.start_time = time.time()
+        self.end_time = None
+        self._error = None
+        self._event = threading.Event()
+
+    def _finish(self, error=None):
+        if not self._event.is_set():
+            self._error = error
+            self.end_time = time.time()
+            self._event.set()
+
+    def done(self):
+        """Check if the sequence has finished"""
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the sequence to finish, returns False on timeout"""
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the sequence to finish and return its duration.
+        Raises an exception on timeout or if the sequence failed."""
+        if not self.wait(timeout):
+            raise laserball_exception.LaserballException("Sequence not finished after %s s" % timeout)
+        if self._error is not None:
+            raise laserball_exception.LaserballException("Sequence failed: %s" % self._error)
+        return self.end_time - self.start_time
+
 
 ##################################################
 # Command options and corresponding buffer outputs
 #
 
+def raw_echo(data, pending=None):
+    """Get every character the control chip sends back for data.
+    pending is a [command, operands still to come] list carried between
+    writes that split a command, and is updated."""
+    if pending is None:
+        pending = [None, 0]
+    echo = ''
+    for c in data:
+        echo += c
+        if pending[0] is None:
+            if c not in _operands:
+                continue
+            pending[:] = [c, _operands[c]]
+        else:
+            pending[1] -= 1
+        if pending[1] == 0:
+            if pending[0] not in _no_repeat:
+                echo += pending[0]
+            pending[0] = None
+    return echo
+
+
+def expected_echo(command):
+    """Get the command characters the control chip echoes for a command list.
+    Each command is echoed back, with its operands, followed by its command
+    character, apart from a channel clear which only echoes itself."""
+    return "".join(c for c in raw_echo("".join(command)) if c in _cmd_set)
+
+
+class EchoParser(object):
+    """Incremental parser for the reply to a command.
+
+    Bytes are fed in as they arrive and sorted into the expected echo,
+    end of sequence markers (K not expected as part of the echo) and
+    garbage (anything that is not a command character).  If strict, any
+    other command character is a mismatch, otherwise it is skipped.  With
+    wait_end the reply is only complete once an end of sequence is seen.
+    """
+
+    def __init__(self, expected, wait_end=False, strict=True):
+        self.expected = expected
+        self.wait_end = wait_end
+        self.strict = strict
+        self.matched = 0
+        self.mismatch = False
+        self.ends = 0
+        self.echo = ''
+        self.garbage = ''
+        self.raw = ''
+
+    def feed(self, chunk):
+        self.raw += chunk
+        expected = self.expected
+        for c in chunk:
+            if c not in _cmd_set:
+                self.garbage += c
+                continue
+            expecting = self.matched < len(expected) and not self.mismatch
+            if c == _buffer_end_sequence and not (expecting and expected[self.matched] == c):
+                self.ends += 1
+                continue
+            self.echo += c
+            if expecting and expected[self.matched] == c:
+                self.matched += 1
+            elif self.strict:
+                self.mismatch = True
+
+    def echo_complete(self):
+        return self.matched == len(self.expected)
+
+    def complete(self):
+        """True once there is no need to read any more"""
+        if self.mismatch:
+            return True
+        return self.echo_complete() and (self.ends > 0 or not self.wait_end)
+
+    def success(self):
+        """True if the expected echo was seen, and nothing else"""
+        return self.echo_complete() and not self.mismatch
+
+
+# A command ready to send: the list of writes, the data for
+# a single write and the expected echo
+CompiledCommand = collections.namedtuple("CompiledCommand", ["command", "data", "buffer_check"])
+
+
+def compile_command(command):
+    """Get the CompiledCommand for a chr/str or list command"""
+    if type(command) is str:
+        command = [command]
+    if type(command) is not list:
+        raise laserball_exception.LaserballException("Command is not a list: %s %s" % (command, type(command)))
+    return CompiledCommand(command, "".join(command), expected_echo(command))
+
+
+class CommandCache(object):
+    """Compiled commands for (encoder, value) pairs, keeping the
+    most recently used size entries.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, encoder, par):
+        # the type is part of the key, so e.g. 1.0 is still checked by
+        # the encoder rather than sharing the entry for 1
+        key = (encoder, type(par), par)
+        with self._lock:
+            compiled = self._cache.pop(key, None)
+            if compiled is not None:
+                self._cache[key] = compiled
+                self.hits += 1
+                return compiled
+        command, buffer_check = encoder(par)
+        compiled = compile_command(command)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = compiled
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_command_cache = CommandCache()
+
+
+def compiled_command(encoder, par):
+    """Get the CompiledCommand for encoder(par), e.g.
+    compiled_command(command_pulse_height, 8000), from the shared cache"""
+    return _command_cache.get(encoder, par)
+
+
 def command_pulse_height(par):
     """Get the command to set a pulse height"""
     if par > _max_pulse_height or par < 0:
@@ -402,7 +1470,7 @@ def command_pulse_width(par):
 def command_pulse_number(par):
     """Get the command to set a pulse number"""
     if par > _max_pulse_number or par < 0:
-        raise laser_exception.LaserballException("Invalid pulse number: %s" % (par))
+        raise laserball_exception.LaserballException("Invalid pulse number: %s" % (par))
     par = int(par)
     adjusted, actual_par, hi, lo = parameters.pulse_number(par)
     if adjusted is True:
@@ -413,13 +1481,31 @@ def command_pulse_number(par):
     return command, buffer_check
 
 
+def quantise_pulse_delay(par):
+    """The pulse delay the box applies when asked for par: whole ms
+    plus a number of 4 us steps, as sent by command_pulse_delay"""
+    ms = int(par)
+    return ms + int((par - ms) * 250) / 250.
+
+
 def command_pulse_delay(par):
     """Get the command to set a pulse delay"""
-    if par > _max_pulse_delay or par < 0:
+    if not 0 <= par <= _max_pulse_delay:
         raise laserball_exception.LaserballException("Invalid pulse delay: %s" % par)
     ms = int(par)
+    #_max_pulse_delay allows a little over the most the ms byte can hold
+    if ms > 255:
+        raise laserball_exception.LaserballException("Invalid pulse delay: %s" % par)
     us = int((par-ms)*250)
     command = [_cmd_pd+chr(ms)]
     command+= [chr(us)]
     buffer_check = _cmd_pd
     return command, buffer_check
+
+
+# (name, cache attribute, encoder) for each setting, in the order
+# apply_settings sends them
+_settings = [("height", "_current_ph", command_pulse_height),
+             ("width", "_current_pw", command_pulse_width),
+             ("delay", "_current_pd", command_pulse_delay),
+             ("number", "_current_pn", command_pulse_number)]
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# serial_session
+#
+# RecordingSerial, ReplaySerial
+#
+# Record every byte written to and read from the control
+# chip, and replay recorded sessions without the box attached.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import optparse
+import struct
+import threading
+import time
+
+# monotonic clock where available (python 3)
+_clock = getattr(time, "monotonic", time.time)
+
+# File layout: a header of magic, version and the wall clock start time,
+# then one record per write/read of direction, seconds since the start
+# (monotonic), data length and the data itself.
+_magic = b"LBSS"
+_version = 1
+_header = struct.Struct("<4sBd")
+_record = struct.Struct("<BdH")
+WRITE = 0
+READ = 1
+
+
+def _to_bytes(data):
+    if isinstance(data, bytearray):
+        return bytes(data)
+    if not isinstance(data, bytes):
+        data = data.encode("latin-1")
+    return data
+
+
+def load_session(path):
+    """Read a session file, returns (start time, [(direction, time, data)])"""
+    with open(path, "rb") as f:
+        header = f.read(_header.size)
+        magic, version, start = _header.unpack(header)
+        if magic != _magic or version != _version:
+            raise IOError("Not a laserball session file: %s" % path)
+        records = []
+        while True:
+            raw = f.read(_record.size)
+            if len(raw) < _record.size:
+                break
+            direction, timestamp, length = _record.unpack(raw)
+            records.append((direction, timestamp, f.read(length)))
+    return start, records
+
+
+class RecordingSerial(object):
+    """Wraps a pyserial-like device, recording all writes and
+    (non-empty) reads to a session file.  Anything else is passed
+    through to the device.
+    """
+
+    def __init__(self, device, path):
+        self._device = device
+        self._lock = threading.Lock()
+        self._file = open(path, "wb")
+        self._start = _clock()
+        self._file.write(_header.pack(_magic, _version, time.time()))
+
+    def _record(self, direction, data):
+        data = _to_bytes(data)
+        with self._lock:
+            if self._file is None:
+                return
+            # data longer than a record can hold is split
+            for i in range(0, max(len(data), 1), 0xffff):
+                chunk = data[i:i + 0xffff]
+                self._file.write(_record.pack(direction, _clock() - self._start, len(chunk)))
+                self._file.write(chunk)
+
+    def write(self, data):
+        self._record(WRITE, data)
+        return self._device.write(data)
+
+    def read(self, size=1):
+        data = self._device.read(size)
+        if data:
+            self._record(READ, data)
+        return data
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+        if hasattr(self._device, "flush"):
+            self._device.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self._device.close()
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+
+class ReplaySerial(object):
+    """pyserial-like device that plays back the reads of a recorded
+    session.  Each read chunk becomes available after the write that
+    preceded it in the recording; with realtime it also waits for the
+    recorded delay after that write, otherwise it is available as soon
+    as the write has been made.  Writes that differ from the recording
+    are counted in write_mismatches (and raise IOError if strict).
+    """
+
+    def __init__(self, path, realtime=True, strict=False, timeout=1):
+        self.port = path
+        self.name = path
+        self.timeout = timeout
+        self.baudrate = None
+        self.realtime = realtime
+        self.strict = strict
+        self.write_mismatches = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        start, records = load_session(path)
+        self._writes = [] # recorded write data and time
+        self._reads = [] # (index of preceding write, delay after it, data)
+        last_write = None
+        for direction, timestamp, data in records:
+            if direction == WRITE:
+                self._writes.append((data, timestamp))
+                last_write = (len(self._writes) - 1, timestamp)
+            elif last_write is None:
+                self._reads.append((-1, timestamp, data))
+            else:
+                self._reads.append((last_write[0], timestamp - last_write[1], data))
+        self._write_times = [] # when each recorded write was replayed
+        self._write_data = b""
+        self._lock = threading.Lock()
+        self._start = _clock()
+        self._read_index = 0
+        self._read_offset = 0
+        self._open = True
+
+    def _chunk_ready(self, index, now):
+        write, delay, data = self._reads[index]
+        if write >= len(self._write_times):
+            return False
+        if not self.realtime:
+            return True
+        anchor = self._start if write < 0 else self._write_times[write]
+        return anchor + delay <= now
+
+    def _available(self, now):
+        n = 0
+        index = self._read_index
+        offset = self._read_offset
+        while index < len(self._reads) and self._chunk_ready(index, now):
+            n += len(self._reads[index][2]) - offset
+            offset = 0
+            index += 1
+        return n
+
+    def write(self, data):
+        data = _to_bytes(data)
+        with self._lock:
+            self.bytes_written += len(data)
+            self._write_data += data
+            # match the written data against the recorded writes
+            while len(self._write_times) < len(self._writes):
+                recorded = self._writes[len(self._write_times)][0]
+                if len(self._write_data) < len(recorded):
+                    break
+                if self._write_data[:len(recorded)] != recorded:
+                    self.write_mismatches += 1
+                    if self.strict:
+                        raise IOError("Write %r does not match recording %r" % (self._write_data, recorded))
+                self._write_data = self._write_data[len(recorded):]
+                self._write_times.append(_clock())
+        return len(data)
+
+    def inWaiting(self):
+        with self._lock:
+            return self._available(_clock())
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        start = _clock()
+        while True:
+            with self._lock:
+                now = _clock()
+                n = self._available(now)
+                finished = self._read_index >= len(self._reads)
+                if n >= size or finished or not self.realtime or \
+                        (self.timeout is not None and now - start >= self.timeout):
+                    return self._take(min(n, size))
+            time.sleep(0.0005)
+
+    def _take(self, n):
+        out = b""
+        while n > 0:
+            data = self._reads[self._read_index][2]
+            chunk = data[self._read_offset:self._read_offset + n]
+            out += chunk
+            n -= len(chunk)
+            self._read_offset += len(chunk)
+            if self._read_offset >= len(data):
+                self._read_index += 1
+                self._read_offset = 0
+        self.bytes_read += len(out)
+        return out
+
+    def finished(self):
+        """True once every recorded read has been played back"""
+        return self._read_index >= len(self._reads)
+
+    def flushInput(self):
+        with self._lock:
+            self._take(self._available(_clock()))
+
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def setRTS(self, level=True):
+        pass
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def isOpen(self):
+        return self._open
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def __repr__(self):
+        return "ReplaySerial(%r, realtime=%r)" % (self.port, self.realtime)
+
+
+def dump(path):
+    """Print a session, one line per write/read"""
+    start, records = load_session(path)
+    print("Session started %s, %d records" % (time.strftime("%Y/%m/%d-%H:%M:%S", time.localtime(start)),
+                                              len(records)))
+    for direction, timestamp, data in records:
+        print("%12.6f %s %r" % (timestamp, "W" if direction == WRITE else "R", data))
+
+
+if __name__=="__main__":
+    parser = optparse.OptionParser(usage="%prog session_file")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give a session file")
+    dump(args[0])
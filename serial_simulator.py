@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# serial_simulator
+#
+# SimulatedSerial
+#
+# In-process stand in for the laserball control chip
+# behind a pyserial-like interface, for use without
+# the box attached.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import random
+import threading
+import time
+
+# Number of bytes following each command character before the
+# command is complete.  The pulse width lo byte is always followed
+# by the load character, which the chip treats as part of the command.
+_operands = {"L": 1, "M": 1, "P": 0,
+             "Q": 1, "R": 2,
+             "H": 1, "G": 1,
+             "u": 2,
+             "C": 0, "g": 0, "a": 0, "@": 0}
+# Commands the chip does not repeat once they have been processed
+_no_repeat = ["C"]
+_end_sequence = "K"
+_cmd_chars = "agK@CLMPQRSHGuT"
+
+_bits_per_char = 10
+
+
+def _to_bytes(data):
+    """Get a bytearray from str/bytes (python 2 or 3)"""
+    if isinstance(data, bytearray):
+        return data
+    if not isinstance(data, bytes):
+        data = data.encode("latin-1")
+    return bytearray(data)
+
+
+class SimulatedSerial(object):
+    """Loopback simulation of the laserball control chip.
+
+    Every byte written is echoed back, and once a command (with its
+    operands) is complete the command character is sent again.  A fire
+    sequence sends the end of sequence character after
+    pulse_number * pulse_delay ms.  All times are in seconds:
+    latency is added to every response, processing_time to each
+    completed command and boot_time after a reset.  If baudrate is
+    None characters are transferred instantly.  garbage_rate is the
+    probability of a random non-command byte following each echoed byte.
+    """
+
+    def __init__(self, port="simulated", baudrate=2400, timeout=1,
+                 latency=0.0, processing_time=0.002, boot_time=0.0,
+                 garbage_rate=0.0, seed=None):
+        self.port = port
+        self.name = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.latency = latency
+        self.processing_time = processing_time
+        self.boot_time = boot_time
+        self.garbage_rate = garbage_rate
+        self._random = random.Random(seed)
+        self._garbage = [b for b in range(256) if chr(b) not in _cmd_chars]
+        self._lock = threading.Lock()
+        self._open = True
+        self._rts = False
+        # counters for the bytes on the wire
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._clear()
+
+    def _clear(self):
+        """Power on state of the chip"""
+        self._output = [] # (time available, byte), in time order
+        self._line_free = 0.
+        self._command = bytearray()
+        self._ready_time = 0.
+        self._end_time = None # when the current sequence finishes
+        self._ph_hi = 0
+        self._ph_lo = 0
+        self._pw_hi = 0
+        self.pulse_height = None
+        self.pulse_width = None
+        self.pulse_number_hi = None
+        self.pulse_number_lo = None
+        self.pulse_delay = None
+        self.firing = False
+        self.firing_continuous = False
+        self.sequences = 0
+
+    def _char_time(self):
+        if not self.baudrate:
+            return 0.
+        return float(_bits_per_char) / self.baudrate
+
+    def _emit(self, byte, when):
+        """Queue a byte to be sent back no earlier than when"""
+        ready = max(when, self._line_free) + self._char_time()
+        self._line_free = ready
+        self._output.append((ready, byte))
+
+    def _echo(self, byte, when):
+        self._emit(byte, when)
+        if self.garbage_rate and self._random.random() < self.garbage_rate:
+            self._emit(self._random.choice(self._garbage), when)
+
+    def _update(self, now):
+        """Finish any sequence that is due"""
+        if self._end_time is not None and self._end_time <= now:
+            self._emit(ord(_end_sequence), self._end_time)
+            self._end_time = None
+            self.firing = False
+
+    def sequence_time(self):
+        """Length of a fire sequence with the current settings"""
+        if None in (self.pulse_number_hi, self.pulse_number_lo, self.pulse_delay):
+            return 0.
+        return self.pulse_number_hi * self.pulse_number_lo * self.pulse_delay / 1000.
+
+    def _process(self, command, when):
+        """Act on a complete command received at time when"""
+        cmd = chr(command[0])
+        done = when + self.processing_time + self.latency
+        if cmd == "L":
+            self._ph_hi = command[1]
+        elif cmd == "M":
+            self._ph_lo = command[1]
+        elif cmd == "P":
+            self.pulse_height = (self._ph_hi << 8) + self._ph_lo
+        elif cmd == "Q":
+            self._pw_hi = command[1]
+        elif cmd == "R":
+            self.pulse_width = (self._pw_hi << 8) + command[1]
+        elif cmd == "H":
+            self.pulse_number_hi = command[1]
+        elif cmd == "G":
+            self.pulse_number_lo = command[1]
+        elif cmd == "u":
+            self.pulse_delay = command[1] + command[2] / 250.
+        elif cmd == "C":
+            self.pulse_height = None
+            self.pulse_width = None
+            self.pulse_number_hi = None
+            self.pulse_number_lo = None
+            self.pulse_delay = None
+        elif cmd == "g":
+            self.firing = True
+            self.sequences += 1
+            self._end_time = done + self.sequence_time()
+        elif cmd == "a":
+            self.firing_continuous = True
+        elif cmd == "@":
+            if self.firing or self.firing_continuous:
+                self._end_time = done
+            self.firing_continuous = False
+        if cmd not in _no_repeat:
+            self._echo(command[0], done)
+
+    def write(self, data):
+        """Send bytes to the chip"""
+        data = _to_bytes(data)
+        with self._lock:
+            if not self._open:
+                raise IOError("Port %s is closed" % self.port)
+            now = time.time()
+            self._update(now)
+            self.bytes_written += len(data)
+            for i, byte in enumerate(data):
+                when = now + (i + 1) * self._char_time()
+                if self._rts or when < self._ready_time:
+                    # chip held in reset or still booting
+                    continue
+                self._echo(byte, when + self.latency)
+                if not self._command and chr(byte) not in _operands:
+                    continue
+                self._command.append(byte)
+                if len(self._command) > _operands[chr(self._command[0])]:
+                    command = self._command
+                    self._command = bytearray()
+                    self._process(command, when)
+        return len(data)
+
+    def _available(self, now):
+        n = 0
+        for ready, byte in self._output:
+            if ready > now:
+                break
+            n += 1
+        return n
+
+    def inWaiting(self):
+        """Number of bytes that can be read without blocking"""
+        with self._lock:
+            now = time.time()
+            self._update(now)
+            return self._available(now)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        """Read up to size bytes, blocking for at most timeout seconds"""
+        start = time.time()
+        while True:
+            with self._lock:
+                if not self._open:
+                    raise IOError("Port %s is closed" % self.port)
+                now = time.time()
+                self._update(now)
+                n = self._available(now)
+                if n >= size or (self.timeout is not None and now - start >= self.timeout):
+                    n = min(n, size)
+                    out = bytearray(byte for ready, byte in self._output[:n])
+                    del self._output[:n]
+                    self.bytes_read += n
+                    return bytes(out)
+            time.sleep(0.0005)
+
+    def flushInput(self):
+        with self._lock:
+            now = time.time()
+            self._update(now)
+            del self._output[:self._available(now)]
+
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+
+    reset_output_buffer = flushOutput
+
+    def flush(self):
+        pass
+
+    def setRTS(self, level=True):
+        """RTS held high keeps the chip in reset"""
+        with self._lock:
+            if level and not self._rts:
+                self._clear()
+            elif not level and self._rts:
+                self._ready_time = time.time() + self.boot_time
+            self._rts = level
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def isOpen(self):
+        return self._open
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def __repr__(self):
+        return "SimulatedSerial(port=%r, baudrate=%r, latency=%r)" % (self.port, self.baudrate, self.latency)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# status_block
+#
+# StatusWriter, StatusReader
+#
+# Live driver state in a fixed layout memory mapped file, which
+# any number of local monitors can poll without parsing logs.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import mmap
+import optparse
+import os
+import struct
+import tempfile
+import threading
+import time
+import laserball_exception
+
+# File layout (little endian): a header of magic, version and the
+# sequence number, then the status.  The writer makes the sequence odd
+# while it updates the status and even again once it has finished, so
+# a reader that sees the same even sequence before and after reading
+# has a consistent copy (a sequence lock).  Unknown settings are -1
+# (delay NaN).  The last command is given by the command characters of
+# its echo, truncated to 32.
+_magic = b"LBST"
+_version = 1
+_header = struct.Struct("<4sBxxxQ")
+_sequence = struct.Struct("<Q")
+_sequence_offset = 8
+counters = ["commands", "command_errors", "echo_mismatches", "echo_timeouts",
+            "retries", "resyncs", "unexpected_bytes"]
+_body = struct.Struct("<qqqdB32sddI" + "I" * len(counters))
+size = _header.size + _body.size
+
+# flag bits
+FIRING = 1
+FIRING_CONTINUOUS = 2
+CONNECTED = 4
+
+_fields = ["height", "width", "number", "delay",
+           "firing", "firing_continuous", "connected",
+           "last_command", "last_command_time", "update_time", "pid"]
+Status = collections.namedtuple("Status", ["sequence"] + _fields + counters)
+
+
+def _int(value):
+    if value is None:
+        return -1
+    return int(value)
+
+
+def _float(value):
+    if value is None:
+        return float("nan")
+    return float(value)
+
+
+class StatusWriter(object):
+    """Owns a status block file, creating (or replacing) it.
+    Only one process should write a block; within it, updates from
+    any thread are serialised."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._counts = dict((name, 0) for name in counters)
+        self._values = {"height": None, "width": None, "number": None, "delay": None,
+                        "firing": False, "firing_continuous": False, "connected": False,
+                        "last_command": "", "last_command_time": None}
+        self._sequence = 0
+        # build the new block beside the old one and rename it over, so
+        # readers of the old block are never left with a truncated file
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(prefix=".status_block", dir=directory)
+        try:
+            os.write(fd, b"\0" * size)
+            self._file = os.fdopen(fd, "r+b")
+            self._map = mmap.mmap(self._file.fileno(), size)
+            _header.pack_into(self._map, 0, _magic, _version, 0)
+            self.update()
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def count(self, name, n=1):
+        """Add to one of the counters (see counters)"""
+        with self._lock:
+            self._counts[name] += n
+
+    def update(self, **values):
+        """Set any of height, width, number, delay, firing,
+        firing_continuous, connected, last_command and
+        last_command_time, and publish the block"""
+        with self._lock:
+            if self._map is None:
+                return
+            self._values.update(values)
+            v = self._values
+            flags = 0
+            if v["firing"]:
+                flags |= FIRING
+            if v["firing_continuous"]:
+                flags |= FIRING_CONTINUOUS
+            if v["connected"]:
+                flags |= CONNECTED
+            command = v["last_command"]
+            if not isinstance(command, bytes):
+                command = command.encode("latin-1", "replace")
+            self._sequence += 1
+            _sequence.pack_into(self._map, _sequence_offset, self._sequence)
+            _body.pack_into(self._map, _header.size,
+                            _int(v["height"]), _int(v["width"]), _int(v["number"]), _float(v["delay"]),
+                            flags, command[:32],
+                            _float(v["last_command_time"]), time.time(), os.getpid(),
+                            *[self._counts[name] for name in counters])
+            self._sequence += 1
+            _sequence.pack_into(self._map, _sequence_offset, self._sequence)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+                self._map = None
+
+
+class StatusReader(object):
+    """Reads a status block written by a StatusWriter (in any process)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, sequence = _header.unpack_from(self._map, 0)
+        if magic != _magic or version != _version:
+            self.close()
+            raise laserball_exception.LaserballException("Not a laserball status block: %s" % path)
+
+    def sequence(self):
+        """The current sequence number, which changes on every update;
+        a cheap check for whether read() has anything new"""
+        return _sequence.unpack_from(self._map, _sequence_offset)[0]
+
+    def read(self, spins=10000):
+        """A consistent copy of the status, as a Status"""
+        for i in range(spins):
+            before = self.sequence()
+            if before & 1:
+                # being written, give the writer a chance to finish
+                time.sleep(0)
+                continue
+            body = _body.unpack_from(self._map, _header.size)
+            if self.sequence() == before:
+                break
+        else:
+            raise laserball_exception.LaserballException("Status block %s is not settling" % self.path)
+        height, width, number, delay, flags, command, command_time, update_time, pid = body[:9]
+        return Status(before,
+                      None if height < 0 else height,
+                      None if width < 0 else width,
+                      None if number < 0 else number,
+                      None if delay != delay else delay,
+                      bool(flags & FIRING), bool(flags & FIRING_CONTINUOUS), bool(flags & CONNECTED),
+                      command.rstrip(b"\0").decode("latin-1"),
+                      None if command_time != command_time else command_time,
+                      update_time, pid,
+                      *body[9:])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+
+if __name__=="__main__":
+    parser = optparse.OptionParser(usage="%prog [-i interval] status_file")
+    parser.add_option("-i", dest="interval", type="float", default=None,
+                      help="Keep printing the status every interval seconds")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give a status file")
+    reader = StatusReader(args[0])
+    last = None
+    while True:
+        status = reader.read()
+        if status.sequence != last:
+            print(", ".join("%s=%s" % item for item in zip(Status._fields, status)))
+            last = status.sequence
+        if options.interval is None:
+            break
+        time.sleep(options.interval)
@@ -0,0 +1,669 @@
+#!/usr/bin/env python
+#
+# test_laserball
+#
+# Regression tests for the drivers, run against the simulated
+# control chip in serial_simulator:  python -m pytest
+#
+# History:
+# 2026/10/17: First instance
+#
+###########################################
+###########################################
+
+import asyncio
+import threading
+import time
+import pytest
+import continuous_session
+import laserball_exception
+import laserball_metrics
+import serial_command
+import serial_simulator
+
+# fast enough to keep the tests short, slow enough that characters
+# still take time on the wire
+baud = 38400
+
+
+class FlakySerial(object):
+    """Wraps a device, replacing the next corrupt echoed command
+    characters in chars with X"""
+
+    def __init__(self, device, chars="MHu"):
+        self._device = device
+        self.chars = chars
+        self.corrupt = 0
+
+    def read(self, size=1):
+        data = self._device.read(size)
+        if self.corrupt and data:
+            data = bytearray(data)
+            for i, byte in enumerate(data):
+                if chr(byte) in self.chars:
+                    data[i] = ord("X")
+                    self.corrupt -= 1
+                    break
+            data = bytes(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+
+class BytesOnlySerial(object):
+    """Wraps a device, only accepting bytes to write as pyserial does
+    on python 3"""
+
+    def __init__(self, device):
+        self._device = device
+
+    def write(self, data):
+        if not isinstance(data, (bytes, bytearray)):
+            raise TypeError("unicode strings are not supported, please encode to bytes: %r" % data)
+        return self._device.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+
+def make_command(device=None, **kwargs):
+    if device is None:
+        device = serial_simulator.SimulatedSerial(baudrate=baud)
+    kwargs.setdefault("baud_rate", baud)
+    return serial_command.SerialCommand(device=device, **kwargs)
+
+
+@pytest.fixture
+def sim():
+    return serial_simulator.SimulatedSerial(baudrate=baud)
+
+
+@pytest.fixture
+def sc(sim):
+    sc = make_command(sim)
+    yield sc
+    sc.close()
+
+
+def setup(sc, height=8000, width=0, number=20, delay=1):
+    sc.apply_settings(height=height, width=width, number=number, delay=delay)
+
+
+def test_pipelined_settings_reach_the_chip(sc, sim):
+    setup(sc, height=8000, width=300, number=20, delay=1.5)
+    assert sim.pulse_height == 8000
+    assert sim.pulse_width == 300
+    assert sim.pulse_number_hi * sim.pulse_number_lo == 20
+    assert sim.pulse_delay == 1.5
+
+
+@pytest.mark.parametrize("pipelined", [True, False])
+def test_writes_bytes(sim, pipelined):
+    sc = make_command(BytesOnlySerial(sim), pipelined=pipelined)
+    try:
+        setup(sc)
+        assert sim.pulse_height == 8000
+        assert sc.fire().result(5) >= 0.
+    finally:
+        sc.close()
+
+
+def test_legacy_settings_reach_the_chip(sim):
+    sc = make_command(sim, pipelined=False)
+    try:
+        sc.set_pulse_height(1234)
+        sc.set_pulse_delay(2)
+        assert sim.pulse_height == 1234
+        assert sim.pulse_delay == 2
+    finally:
+        sc.close()
+
+
+def test_cached_settings_are_not_resent(sc, sim):
+    setup(sc)
+    written = sim.bytes_written
+    setup(sc)
+    sc.set_pulse_height(8000)
+    assert sim.bytes_written == written
+
+
+def test_fire_completes(sc, sim):
+    setup(sc, number=20, delay=1)
+    handle = sc.fire()
+    assert handle.result(5) >= 0.
+    assert sim.sequences == 1
+    assert not sc.is_firing()
+
+
+def test_short_fire_returns_before_the_sequence_ends(sc, sim):
+    setup(sc, number=450, delay=1)
+    start = time.time()
+    handle = sc.fire()
+    assert time.time() - start < 0.2
+    assert not handle.done()
+    assert handle.result(5) >= 0.
+    assert sim.sequences == 1
+
+
+def test_lost_end_of_sequence_is_not_waited_for_forever(sim):
+    device = FlakySerial(sim, chars="K")
+    sc = make_command(device)
+    try:
+        setup(sc, number=100, delay=1)
+        handle = sc.fire()
+        device.corrupt = 1
+        start = time.time()
+        with pytest.raises(laserball_exception.LaserballException):
+            sc.wait_fire(handle, margin=0.2)
+        # the stop waits its deadline for the end of sequence too
+        assert time.time() - start < 2.0
+        assert not sc.is_firing()
+        # the box was stopped, so the next fire runs normally
+        sc.wait_fire(sc.fire()).result()
+    finally:
+        sc.close()
+
+
+def test_command_cache():
+    cache = serial_command.CommandCache(size=2)
+    first = cache.get(serial_command.command_pulse_height, 100)
+    assert cache.get(serial_command.command_pulse_height, 100) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    # the type is part of the key, so 1. does not share the entry for 1
+    cache.get(serial_command.command_pulse_delay, 1)
+    cache.get(serial_command.command_pulse_delay, 1.)
+    assert cache.misses == 3
+    cache.get(serial_command.command_pulse_height, 200)
+    assert len(cache._cache) == 2
+    with pytest.raises(laserball_exception.LaserballException):
+        cache.get(serial_command.command_pulse_height, -1)
+
+
+def test_echo_mismatch_raises_and_forgets_setting(sim):
+    device = FlakySerial(sim)
+    sc = make_command(device, retries=0)
+    try:
+        setup(sc)
+        device.corrupt = 1
+        with pytest.raises(laserball_exception.LaserballException):
+            sc.set_pulse_number(400)
+        assert sc.get_pulse_number() is None
+        # the other settings are still trusted
+        assert sc.get_pulse_delay() == 1
+    finally:
+        sc.close()
+
+
+def test_retry_and_resync_recover(sim):
+    device = FlakySerial(sim)
+    sc = make_command(device)
+    metrics = sc.enable_metrics(laserball_metrics.Metrics())
+    try:
+        setup(sc)
+        device.corrupt = 1
+        sc.set_pulse_number(400)
+        assert sc.get_pulse_number() == 400
+        assert sim.pulse_number_hi * sim.pulse_number_lo == 400
+        assert metrics.get_count("retries") == 1
+        assert metrics.get_count("recoveries") == 1
+        assert metrics.get_count("resyncs") == 1
+        # the link is usable afterwards
+        sc.set_pulse_height(100)
+        assert sim.pulse_height == 100
+    finally:
+        sc.close()
+
+
+def test_retries_give_up(sim):
+    device = FlakySerial(sim)
+    sc = make_command(device, retries=2, retry_backoff=0.)
+    metrics = sc.enable_metrics(laserball_metrics.Metrics())
+    try:
+        setup(sc)
+        device.corrupt = 100
+        with pytest.raises(laserball_exception.LaserballException):
+            sc.set_pulse_number(400)
+        assert metrics.get_count("retries") == 2
+        assert metrics.get_count("retry_failures") == 1
+    finally:
+        sc.close()
+
+
+def test_expected_echo_with_command_operands():
+    # a delay of 1.3 ms sends the end of sequence character as its us byte
+    command, buffer_check = serial_command.command_pulse_delay(1.3)
+    assert serial_command.raw_echo("".join(command)) == "u\x01Ku"
+    assert serial_command.expected_echo(command) == "uKu"
+    # a command split across writes is only repeated once it is complete
+    pending = [None, 0]
+    assert serial_command.raw_echo(command[0], pending) == "u\x01"
+    assert serial_command.raw_echo(command[1], pending) == "Ku"
+
+
+def test_end_of_sequence_operands_are_not_ends(sc, sim):
+    setup(sc, number=20, delay=1.3)
+    assert sim.pulse_delay == 1.3
+    assert sc._port_reader.ends == 0
+
+
+def test_end_of_sequence_operand_while_firing(sc, sim):
+    setup(sc, number=2500, delay=2)
+    handle = sc.fire()
+    time.sleep(0.2)
+    # a width of 75 is sent as a lo byte of "K", which is only an echo
+    sc.set_pulse_width(75, while_fire=True)
+    time.sleep(0.2)
+    assert not handle.done()
+    assert sc.is_firing()
+    assert sim.pulse_width == 75
+    sc.stop()
+
+
+def test_continuous_session_streams_every_width(sc, sim):
+    setup(sc)
+    with continuous_session.ContinuousSession(sc) as session:
+        # the widths include 75, sent as the end of sequence character
+        assert session.stream(range(1, 200, 2)) == 100
+    assert session.sent == 100
+    assert sim.pulse_width == 199
+    assert not sc.is_firing_continuous()
+
+
+def test_width_while_firing_is_checked(sim):
+    device = FlakySerial(sim, chars="S")
+    sc = make_command(device)
+    metrics = sc.enable_metrics(laserball_metrics.Metrics())
+    try:
+        setup(sc)
+        sc.fire_continuous()
+        device.corrupt = 1
+        sc.set_pulse_width(300, while_fire=True)
+        # retried without a stop, so still firing
+        assert metrics.get_count("retries") == 1
+        assert sc.is_firing_continuous()
+        assert sim.pulse_width == 300
+        sc.stop()
+    finally:
+        sc.close()
+
+
+def test_reset_polls_until_booted():
+    sim = serial_simulator.SimulatedSerial(baudrate=baud, boot_time=0.3)
+    sc = make_command(sim)
+    try:
+        setup(sc)
+        start = time.time()
+        sc.reset(hold=0.1)
+        assert 0.4 <= time.time() - start < 1.0
+        assert sc.get_pulse_number() is None
+        setup(sc)
+        assert sim.pulse_height == 8000
+    finally:
+        sc.close()
+
+
+def test_no_echoes_left_due_after_reset():
+    sim = serial_simulator.SimulatedSerial(baudrate=baud, boot_time=0.3)
+    sc = make_command(sim)
+    try:
+        sc.reset(hold=0.1)
+        setup(sc, number=2500, delay=2)
+        handle = sc.fire()
+        sc.set_pulse_width(75, while_fire=True)
+        time.sleep(0.2)
+        assert not handle.done()
+        assert sc.is_firing()
+        sc.stop()
+    finally:
+        sc.close()
+
+
+def run_async(test, **kwargs):
+    """Run a coroutine function with an AsyncSerialCommand on a
+    simulated chip, made with kwargs"""
+    import async_command
+
+    async def main():
+        sim = serial_simulator.SimulatedSerial(baudrate=baud, **kwargs)
+        sc = async_command.AsyncSerialCommand.simulated(sim)
+        try:
+            await test(sc, sim)
+        finally:
+            await sc.close()
+    asyncio.run(main())
+
+
+def test_async_stop_then_fire():
+    async def test(sc, sim):
+        await sc.set_pulse_height(8000)
+        await sc.set_pulse_width(0)
+        await sc.set_pulse_number(500)
+        await sc.set_pulse_delay(1)
+        await sc.fire_continuous()
+        await sc.stop()
+        # the end of sequence from the stop must not complete this fire
+        sequence = await sc.fire()
+        assert not sequence.done()
+        start = time.time()
+        await sequence
+        assert time.time() - start > 0.3
+    # the end of sequence arrives well after the stop echo
+    run_async(test, latency=0.02)
+
+
+def test_async_end_of_sequence_operand_while_firing():
+    async def test(sc, sim):
+        await sc.set_pulse_height(8000)
+        await sc.set_pulse_width(0)
+        await sc.set_pulse_number(2500)
+        await sc.set_pulse_delay(1.3)
+        sequence = await sc.fire()
+        await sc.set_pulse_width(75, while_fire=True)
+        assert not sequence.done()
+        assert sc.is_firing()
+        await sc.stop()
+    run_async(test)
+
+
+def test_async_clear_channel_forgets_settings():
+    async def test(sc, sim):
+        await sc.set_pulse_number(20)
+        await sc.clear_channel()
+        assert sc.get_pulse_number() is None
+        with pytest.raises(laserball_exception.LaserballException):
+            sc.check_ready()
+    run_async(test)
+
+
+def test_async_reset_polls_until_booted():
+    async def test(sc, sim):
+        await sc.set_pulse_number(20)
+        start = time.time()
+        await sc.reset(hold=0.1)
+        assert 0.4 <= time.time() - start < 1.0
+        assert sc.get_pulse_number() is None
+        await sc.set_pulse_number(20)
+        assert sim.pulse_number_hi * sim.pulse_number_lo == 20
+        # no echoes of the unanswered stops are left to hide a K operand
+        await sc.set_pulse_height(8000)
+        await sc.set_pulse_width(0)
+        await sc.set_pulse_number(2500)
+        await sc.set_pulse_delay(2)
+        sequence = await sc.fire()
+        await sc.set_pulse_width(75, while_fire=True)
+        await asyncio.sleep(0.2)
+        assert not sequence.done()
+        assert sc.is_firing()
+        await sc.stop()
+    run_async(test, boot_time=0.3)
+
+
+def test_manager_stop_during_fire():
+    import laserball_manager
+    manager = laserball_manager.LaserballManager()
+    try:
+        for port in ["box1", "box2"]:
+            manager.add(port, serial_simulator.SimulatedSerial(port, baudrate=baud))
+        manager.configure(height=8000, width=0, number=4000, delay=1)
+        fire = threading.Thread(target=manager.fire)
+        fire.start()
+        time.sleep(0.2)
+        start = time.time()
+        results = manager.stop()
+        assert time.time() - start < 1.0
+        assert all(result.error is None for result in results.values())
+        fire.join(2.0)
+        assert not fire.is_alive()
+    finally:
+        manager.close()
+
+
+@pytest.mark.parametrize("delay", [256.01, -1, float("nan")])
+def test_run_file_rejects_bad_delays(delay):
+    import run_file
+    with pytest.raises(laserball_exception.LaserballException):
+        run_file.parse("set delay=%r" % delay)
+    with pytest.raises(laserball_exception.LaserballException):
+        serial_command.command_pulse_delay(delay)
+
+
+def test_run_file_checks_repeats_without_unrolling():
+    import run_file
+    start = time.time()
+    run = run_file.parse("set height=1 width=0 number=20 delay=1\n"
+                         "repeat 200000\n set width=1\n fire\n set width=2\n fire\nend")
+    summary = run.summary()
+    run.estimate()
+    assert time.time() - start < 0.5
+    assert summary["fire"] == 400000
+    assert summary["settings"] == 400000
+    with pytest.raises(laserball_exception.LaserballException):
+        run_file.parse("repeat 200000\n fire\nend")
+
+
+def test_run_file_repeats_unroll_in_order():
+    import run_file
+    run = run_file.parse("set height=1 width=0 number=20 delay=1\n"
+                         "repeat 3\n fire\n set width=5\nend")
+    ops = [(step.op, step.args) for step in run.unroll(run.compile())]
+    assert ops == [("settings", {"height": 1, "width": 0, "number": 20, "delay": 1.0}),
+                   ("fire", None), ("settings", {"width": 5}), ("fire", None), ("fire", None)]
+
+
+def _brute_force_pulse_number(number):
+    """The search parameters.pulse_number made before its lookup tables"""
+    hi = -1
+    lo = -1
+    diff = 100000
+    for i in range(1, 256):
+        lo_check = min(number // i, 255)
+        check = i * lo_check
+        if abs(check - number) < diff:
+            diff = abs(check - number)
+            hi = i
+            lo = lo_check
+        if check == number:
+            break
+    return hi * lo != number, hi * lo, hi, lo
+
+
+def test_pulse_number_matches_brute_force():
+    import parameters
+    wrong = [number for number in range(parameters.max_pulse_number + 1)
+             if parameters.pulse_number(number) != _brute_force_pulse_number(number)]
+    assert wrong == []
+
+
+def test_nearest_pulse_number():
+    import parameters
+    # 257 is prime, 256 and 258 are equally near: rounds down
+    assert parameters.nearest_pulse_number(257) == (256, 2, 128)
+    # 540 and 543 can be set, 542 = 2 * 271 cannot
+    assert parameters.nearest_pulse_number(542)[0] == 543
+    assert parameters.pulse_number(542)[:2] == (True, 540)
+    assert parameters.nearest_pulse_number(20) == (20, 1, 20)
+    assert parameters.nearest_pulse_number(parameters.max_pulse_number) == (65025, 255, 255)
+
+
+def test_achievable_pulse_numbers_bounds():
+    import parameters
+    # both bounds are included
+    assert parameters.achievable_pulse_numbers(256, 258) == [256, 258]
+    assert parameters.achievable_pulse_numbers(257, 257) == []
+    assert parameters.achievable_pulse_numbers(64516, 65025) == [64516, 64770, 65025]
+    assert parameters.achievable_pulse_numbers(64771, 65024) == []
+    everything = parameters.achievable_pulse_numbers()
+    assert everything[0] == 0 and everything[-1] == parameters.max_pulse_number
+    assert all(parameters.is_achievable(number) for number in everything[::97])
+
+
+def test_recorded_session_replays(sim, tmp_path):
+    import serial_session
+    path = str(tmp_path / "session")
+    sc = make_command(sim, record=path)
+    try:
+        setup(sc)
+        sc.fire().result(5)
+    finally:
+        sc.close()
+    replay = serial_session.ReplaySerial(path, strict=True)
+    sc = make_command(replay)
+    try:
+        setup(sc)
+        assert sc.settings() == {"height": 8000, "width": 0, "number": 20, "delay": 1}
+        assert sc.fire().result(5) >= 0.
+    finally:
+        sc.close()
+    assert replay.write_mismatches == 0
+    assert replay.finished()
+
+
+def test_daemon_merges_queued_settings(sc, sim, tmp_path):
+    import laserball_daemon
+    daemon = laserball_daemon.LaserballDaemon(sc, str(tmp_path / "laserball.sock")).start()
+    server = threading.Thread(target=daemon.serve_forever)
+    server.start()
+    try:
+        client = laserball_daemon.LaserballClient(daemon.path, timeout=10)
+        client.set(height=8000, width=0, number=500, delay=1)
+        client.fire()
+        # the next fire waits for the running sequence, holding up the
+        # settings queued behind it
+        threads = [threading.Thread(target=client.fire)]
+        for values in [{"height": 100}, {"width": 50}, {"delay": 2}]:
+            other = laserball_daemon.LaserballClient(daemon.path, timeout=10)
+            threads.append(threading.Thread(target=other.set, kwargs=values))
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        assert daemon.coalesced == 2
+        assert client.get()["height"] == 100
+        assert (sim.pulse_height, sim.pulse_width, sim.pulse_delay) == (100, 50, 2)
+        client.stop()
+        client.close()
+    finally:
+        daemon.shutdown()
+        server.join()
+
+
+def test_status_block_follows_the_driver(sim, tmp_path):
+    import status_block
+    path = str(tmp_path / "status")
+    sc = make_command(sim, status=path)
+    reader = status_block.StatusReader(path)
+    try:
+        setup(sc)
+        status = reader.read()
+        assert (status.height, status.width, status.number, status.delay) == (8000, 0, 20, 1)
+        assert status.connected and not status.firing
+        assert status.commands > 0
+        handle = sc.fire()
+        assert reader.read().firing
+        handle.result(5)
+        sequence = reader.sequence()
+        status = reader.read()
+        assert not status.firing
+        assert status.sequence == sequence
+        sc.close()
+        assert not reader.read().connected
+    finally:
+        reader.close()
+        sc.close()
+
+
+def test_scheduler_calibrates_to_the_box(sc, sim):
+    import run_plan
+    import timing_model
+    # start from a model that is well out, and let the fires correct it
+    model = timing_model.TimingModel(baud_rate=baud, sequence_scale=2.0, fire_overhead=0.3)
+    scheduler = timing_model.Scheduler(model)
+    plan = run_plan.RunPlan([run_plan.Point(8000, 0, number, 1) for number in [100, 400, 100, 400]])
+    results, rest = scheduler.execute(sc, plan, budget=60)
+    assert len(results) == 4 and len(rest) == 0
+    assert 0.8 < model.sequence_scale < 1.25
+    assert model.fire_overhead < 0.05
+    # the refitted model predicts the next fire
+    setup(sc, number=250)
+    start = time.time()
+    sc.fire().result(5)
+    assert abs(model.fire_time(250, 1) - (time.time() - start)) < 0.05
+
+
+def test_stored_settings_expire(tmp_path):
+    import json
+    path = str(tmp_path / "state.json")
+    sc = make_command(state_store=path)
+    setup(sc)
+    sc.close()
+    sc = make_command(state_store=path)
+    sc.connect()
+    assert sc.get_pulse_number() == 20
+    sc.close()
+    with open(path) as f:
+        states = json.load(f)
+    for state in states.values():
+        state["time"] -= 7200
+    with open(path, "w") as f:
+        json.dump(states, f)
+    sc = make_command(state_store=path, state_max_age=3600.)
+    sc.connect()
+    assert sc.get_pulse_number() is None
+    sc.close()
+
+
+def test_settings_start_unknown(sc):
+    assert sc.settings() == {"height": None, "width": None, "number": None, "delay": None}
+    with pytest.raises(laserball_exception.LaserballException):
+        sc.fire()
+    setup(sc, width=75)
+    assert sc.settings() == {"height": 8000, "width": 75, "number": 20, "delay": 1}
+    assert sc.get_pulse_width() == 75
+
+
+def test_daemon_get_reports_unknown_settings(sc):
+    import laserball_daemon
+    daemon = laserball_daemon.LaserballDaemon(sc)
+    state = daemon.get()
+    assert state["height"] is None and state["width"] is None
+    assert state["firing"] is False
+
+
+def test_close_then_reconnect(sim):
+    sc = make_command(sim)
+    try:
+        setup(sc)
+        sc.close()
+        assert not sc.is_connected()
+        sc.connect()
+        assert sc.is_connected()
+        start = time.time()
+        sc.set_pulse_height(100)
+        assert time.time() - start < 0.5
+        assert sim.pulse_height == 100
+    finally:
+        sc.close()
+
+
+def test_async_stop_while_fire_is_queued():
+    async def test(sc, sim):
+        await sc.set_pulse_height(8000)
+        await sc.set_pulse_width(0)
+        await sc.set_pulse_number(3000)
+        await sc.set_pulse_delay(1)
+        sequence = await sc.fire()
+        # waits for the running sequence, without blocking stop()
+        queued = asyncio.ensure_future(sc.fire())
+        setting = asyncio.ensure_future(sc.set_pulse_number(20))
+        await asyncio.sleep(0.1)
+        start = time.time()
+        await sc.stop()
+        assert time.time() - start < 0.5
+        assert sequence.done()
+        next_sequence = await queued
+        await sc.stop()
+        assert next_sequence.done()
+        await setting
+    run_async(test)
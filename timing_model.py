@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#
+# timing_model
+#
+# TimingModel, Scheduler
+#
+# Predict how long fire sequences, settings changes and whole
+# run plans take, and fit scans into a fixed time budget.
+#
+# History:
+# 2026/10/16: First instance
+#
+###########################################
+###########################################
+
+import collections
+import time
+import laserball_exception
+import run_plan
+import serial_command
+
+PlanEstimate = collections.namedtuple("PlanEstimate", ["total", "setup", "firing", "points"])
+
+# characters on the wire for a fire: the command, its echo and repeat,
+# and the end of sequence
+_fire_chars = 4
+
+
+def _fit_line(xs, ys, slope):
+    """Least squares intercept and slope.  The given slope is kept if
+    the xs do not vary enough to fit one, or the fit is not positive."""
+    n = len(xs)
+    mean_x = sum(xs) / float(n)
+    mean_y = sum(ys) / float(n)
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if sxx > 1e-12 * max(1., mean_x ** 2):
+        fitted = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+        if fitted > 0:
+            slope = fitted
+    return mean_y - slope * mean_x, slope
+
+
+class TimingModel(object):
+    """Wall time of laserball operations.
+
+    A fire takes the sequence time (pulse number times the pulse delay
+    the box applies, see serial_command.quantise_pulse_delay) times
+    sequence_scale, plus fire_overhead and the fire characters on the
+    link.  A settings change sends the changed settings in one write
+    (as apply_settings does) and takes the characters on the link, plus
+    command_time for the firmware to process each command and
+    write_latency for the write (USB and driver latency).
+    All times are in seconds.
+    """
+
+    def __init__(self, baud_rate=2400, write_latency=0.01, command_time=0.005,
+                 fire_overhead=0.01, sequence_scale=1.0):
+        self.baud_rate = baud_rate
+        self.write_latency = write_latency
+        self.command_time = command_time
+        self.fire_overhead = fire_overhead
+        self.sequence_scale = sequence_scale
+
+    @classmethod
+    def from_command(cls, sc, **kwargs):
+        """Model for a SerialCommand's link speed, using the echo latency
+        it has measured if it is adaptive"""
+        kwargs.setdefault("baud_rate", sc._baud_rate)
+        kwargs.setdefault("command_time", sc._sleep)
+        if sc.latency is not None and sc.latency.median() is not None:
+            kwargs.setdefault("write_latency", sc.latency.median())
+        return cls(**kwargs)
+
+    def __repr__(self):
+        return "TimingModel(baud_rate=%r, write_latency=%.4g, command_time=%.4g, fire_overhead=%.4g, sequence_scale=%.4g)" % \
+            (self.baud_rate, self.write_latency, self.command_time, self.fire_overhead, self.sequence_scale)
+
+    def char_time(self):
+        if not self.baud_rate:
+            return 0.
+        return float(serial_command._bits_per_char) / self.baud_rate
+
+    def sequence_time(self, number, delay):
+        """Length of a fire sequence, as the box runs it"""
+        return int(number) * serial_command.quantise_pulse_delay(delay) / 1000.
+
+    def fire_time(self, number, delay):
+        """Wall time from fire() to the end of sequence"""
+        return self.fire_overhead + _fire_chars * self.char_time() + \
+            self.sequence_scale * self.sequence_time(number, delay)
+
+    def changed(self, previous, point):
+        """Settings of point (any of which may be None, to leave it) that
+        differ from previous (None, or with None for unknown values)"""
+        names = []
+        for name in run_plan.settings:
+            value = getattr(point, name)
+            if value is None:
+                continue
+            if previous is None or getattr(previous, name) != value:
+                names.append(name)
+        return names
+
+    def command_time_for(self, names, point):
+        """Wall time to send the named settings of point in one write"""
+        if not names:
+            return 0.
+        chars = 0
+        elements = 0
+        for name, attribute, encoder in serial_command._settings:
+            if name in names:
+                command = serial_command.compiled_command(encoder, getattr(point, name))
+                chars += len(command.data) + len(command.buffer_check)
+                elements += len(command.command)
+        return self.write_latency + (chars + 1) * self.char_time() + elements * self.command_time
+
+    def transition_time(self, previous, point):
+        """Wall time to change the settings from previous to point"""
+        point = _point(point)
+        previous = None if previous is None else _point(previous)
+        return self.command_time_for(self.changed(previous, point), point)
+
+    def point_time(self, previous, point):
+        """Wall time to set up and fire at point"""
+        point = _point(point)
+        return self.transition_time(previous, point) + self.fire_time(point.number, point.delay)
+
+    def estimate(self, plan, start=None):
+        """Predict a RunPlan (or list of points) run from the start
+        settings.  Returns a PlanEstimate of the total, setup and firing
+        times and the time of each point."""
+        setup = 0.
+        firing = 0.
+        times = []
+        previous = None if start is None else _point(start)
+        for point in plan:
+            point = _point(point)
+            transition = self.transition_time(previous, point)
+            fire = self.fire_time(point.number, point.delay)
+            setup += transition
+            firing += fire
+            times.append(transition + fire)
+            previous = point
+        return PlanEstimate(setup + firing, setup, firing, times)
+
+    def plan_time(self, plan, start=None):
+        return self.estimate(plan, start).total
+
+    def calibrate_fires(self, samples):
+        """Fit fire_overhead and sequence_scale to measured fires, given
+        as (number, delay, seconds).  The scale needs sequences of at
+        least two lengths, otherwise only the overhead is fitted."""
+        samples = list(samples)
+        if not samples:
+            return self
+        link = _fire_chars * self.char_time()
+        xs = [self.sequence_time(number, delay) for number, delay, seconds in samples]
+        ys = [seconds - link for number, delay, seconds in samples]
+        overhead, self.sequence_scale = _fit_line(xs, ys, self.sequence_scale)
+        self.fire_overhead = max(overhead, 0.)
+        return self
+
+    def calibrate_transitions(self, samples):
+        """Fit write_latency and command_time to measured settings
+        changes, given as (point, names of the settings sent, seconds).
+        command_time needs changes of at least two sizes, otherwise only
+        the latency is fitted."""
+        xs = []
+        ys = []
+        for point, names, seconds in samples:
+            if not names:
+                continue
+            point = _point(point)
+            elements = 0
+            for name, attribute, encoder in serial_command._settings:
+                if name in names:
+                    elements += len(serial_command.compiled_command(encoder, getattr(point, name)).command)
+            # what the model predicts beyond the latency and firmware time
+            link = self.command_time_for(names, point) - self.write_latency - elements * self.command_time
+            xs.append(elements)
+            ys.append(seconds - link)
+        if not xs:
+            return self
+        latency, self.command_time = _fit_line(xs, ys, self.command_time)
+        self.write_latency = max(latency, 0.)
+        return self
+
+
+def _point(point):
+    if isinstance(point, run_plan.Point):
+        return point
+    return run_plan.Point(*point)
+
+
+class Scheduler(object):
+    """Fits the points of a RunPlan into a time budget with a
+    TimingModel, and recalibrates the model from the points it runs.
+    margin is the fraction of the budget kept in reserve.
+    """
+
+    def __init__(self, model=None, margin=0.05, samples=500):
+        if model is None:
+            model = TimingModel()
+        self.model = model
+        self.margin = margin
+        self.fires = collections.deque(maxlen=samples)
+        self.transitions = collections.deque(maxlen=samples)
+
+    def _usable(self, budget):
+        return budget * (1. - self.margin)
+
+    def fits(self, plan, budget, start=None):
+        """Whether the whole plan is predicted to finish within budget"""
+        return self.model.plan_time(plan, start) <= self._usable(budget)
+
+    def fit(self, plan, budget, start=None):
+        """Split plan into the leading points predicted to finish within
+        budget seconds and the rest.  Returns (fitted RunPlan, remaining
+        RunPlan, predicted seconds of the fitted points)."""
+        points = list(plan)
+        usable = self._usable(budget)
+        total = 0.
+        previous = None if start is None else _point(start)
+        n = 0
+        for point in points:
+            point = _point(point)
+            seconds = self.model.point_time(previous, point)
+            if total + seconds > usable:
+                break
+            total += seconds
+            previous = point
+            n += 1
+        return run_plan.RunPlan(points[:n]), run_plan.RunPlan(points[n:]), total
+
+    def observe_fire(self, number, delay, seconds):
+        self.fires.append((number, delay, seconds))
+
+    def observe_transition(self, point, names, seconds):
+        if names:
+            self.transitions.append((point, names, seconds))
+
+    def calibrate(self):
+        """Refit the model to the timings observed so far"""
+        self.model.calibrate_fires(self.fires)
+        self.model.calibrate_transitions(self.transitions)
+        return self.model
+
+    def execute(self, sc, plan, budget, callback=None, calibrate=True):
+        """Run points of plan with a SerialCommand, waiting for each
+        sequence, for as long as the next point is predicted to finish
+        within budget seconds of the start.  Each point is timed and, if
+        calibrate, the model refitted before predicting the next one.
+        callback(point, handle) is called after each fire.
+        Returns (list of (point, FireHandle), RunPlan of the points not run).
+        """
+        plan = run_plan.RunPlan(plan) if not isinstance(plan, run_plan.RunPlan) else plan
+        plan.validate()
+        usable = self._usable(budget)
+        start = time.time()
+        previous = run_plan.current_point(sc)
+        results = []
+        points = list(plan)
+        for i, point in enumerate(points):
+            if time.time() - start + self.model.point_time(previous, point) > usable:
+                return results, run_plan.RunPlan(points[i:])
+            setup_start = time.time()
+            names = sc.apply_settings(**point._asdict())
+            self.observe_transition(point, names, time.time() - setup_start)
+            handle = sc.fire()
+            sc.wait_fire(handle)
+            try:
+                self.observe_fire(point.number, point.delay, handle.result())
+            except laserball_exception.LaserballException:
+                # a stopped or failed sequence says nothing about timing
+                pass
+            if calibrate:
+                self.calibrate()
+            if callback is not None:
+                callback(point, handle)
+            results.append((point, handle))
+            previous = point
+        return results, run_plan.RunPlan([])